@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -82,6 +84,26 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# shared by all server processes: cached data is invalidated by model signals.
+# The file-based cache suits a single server; its directory is outside the project tree and can be set
+# with EXAMLISTS_CACHE_DIR. In production with several servers use memcached as the 'default' cache
+# (django.core.cache.backends.memcached.PyMemcacheCache), or redis through django-redis
+
+CACHE_DIR = Path(os.environ.get('EXAMLISTS_CACHE_DIR', Path(tempfile.gettempdir()) / 'examlists'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR / 'django',
+        # academic differences, subject lists and matches are cached per specialty, semester and upload;
+        # every write lists the directory to check the limit, above it a third of the entries is removed,
+        # version tokens included (a lost token only invalidates the entries that depend on it)
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -129,6 +151,40 @@ MEDIA_ROOT = BASE_DIR / "media"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Subjects comparison
+# 'python' or 'numpy' (batch word matching, requires numpy and scipy)
+SUBJECTS_COMPARISON_BACKEND = 'python'
+# processes for large uploads, 1 - compare in the request process; capped at the CPU count.
+# The process pool keeps the catalog snapshot until the subjects catalog changes
+SUBJECTS_COMPARISON_WORKERS = 1
+# word pairs kept in the per-process fuzzy comparison cache (cleared when full)
+SUBJECTS_WORD_CACHE_SIZE = 100000
+# best match score from which an uploaded subject that differs from it only by typos is linked without review,
+# None - link exact matches only
+SUBJECTS_AUTO_RESOLVE_THRESHOLD = None
+
+# Academic differences
+# threads recomputing the stored differences of a specialty after its plan changes, 0 - recompute in the request
+ACADEMIC_DIFFERENCES_REFRESH_WORKERS = 1
+
+# Parsed workbooks, keyed by file content, sheet and rule; kept out of the Django cache LOCATION
+# so that the two caches can be placed and cleaned up independently
+PARSER_CACHE_DIR = CACHE_DIR / 'parsed'
+# total size of the parsed workbooks cache in bytes, least recently read files are removed first
+PARSER_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# Background upload jobs: parsing and subjects matching run outside the request
+# threads for jobs, 0 - run the job in the request
+UPLOAD_JOBS_WORKERS = 2
+# unfinished jobs allowed at once
+UPLOAD_JOBS_LIMIT = 4
+# seconds without progress after which an unfinished job is considered abandoned
+UPLOAD_JOBS_TIMEOUT = 60 * 60
+# processes parsing the sheets of a batch upload, 1 - parse in the job thread
+UPLOAD_BATCH_WORKERS = 2
+# seconds an unfinished upload is kept between the conflicts and plan items steps
+STAGED_UPLOAD_TTL = 24 * 60 * 60
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = "/"
@@ -18,7 +18,8 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 from listsapp.views import (
-    home, upload_file, subjects_filter_list, academ_difference_list, SubjectConflictView, PlanItemsCreateView,
+    home, upload_file, upload_sheets, upload_batch, upload_job, upload_job_status, subjects_filter_list,
+    academ_difference_list, academ_targets, SubjectConflictView, SubjectConflictRowsView, PlanItemsCreateView,
     SendMessageView
 )
 from django.contrib.auth.views import LoginView, LogoutView
@@ -29,10 +30,16 @@ urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('upload/', upload_file, name='upload'),
+    path('upload/sheets/', upload_sheets, name='upload_sheets'),
+    path('upload/batch/', upload_batch, name='upload_batch'),
+    path('upload/jobs/<int:job_id>/', upload_job, name='upload_job'),
+    path('upload/jobs/<int:job_id>/status/', upload_job_status, name='upload_job_status'),
     path('upload/items/', PlanItemsCreateView.as_view(), name='upload_items'),
     path('upload/conflicts/', SubjectConflictView.as_view(), name='upload_conflicts'),
+    path('upload/conflicts/rows/', SubjectConflictRowsView.as_view(), name='upload_conflicts_rows'),
     path('subjects/', subjects_filter_list, name='subjects'),
     path('academ/', academ_difference_list, name='academ'),
+    path('academ/targets/', academ_targets, name='academ_targets'),
     path('message/', SendMessageView.as_view(), name='message')
 ]
 
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Degree, Specialty, Subject, AcademicPlan, Group, Rule, Faculty, AdminMessage
+from .models import Degree, Specialty, Subject, AcademicPlan, Group, Rule, Faculty, AdminMessage, UploadJob
 
 
 # Register your models here.
@@ -39,6 +39,11 @@ class MessageAdmin(admin.ModelAdmin):
     list_display = ['is_solve', 'user', 'topic', 'mail', 'text', ]
 
 
+class UploadJobAdmin(admin.ModelAdmin):
+    list_display = ['created', 'user', 'specialty', 'status', 'progress', 'error']
+    list_filter = ['status', ]
+
+
 admin.site.register(Degree, DegreeAdmin)
 admin.site.register(Subject, SubjectAdmin)
 admin.site.register(Specialty, SpecialtyAdmin)
@@ -47,3 +52,4 @@ admin.site.register(Group, GroupAdmin)
 admin.site.register(Rule, RuleAdmin)
 admin.site.register(Faculty, FacultyAdmin)
 admin.site.register(AdminMessage, MessageAdmin)
+admin.site.register(UploadJob, UploadJobAdmin)
@@ -5,6 +5,8 @@ from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
+from listsapp.functionality.comparison import FuzzySubjectsComparison
+from listsapp.functionality.workbook import sheets
 from listsapp.models import Degree, Rule, Faculty, Specialty, AcademicPlan, Subject, AdminMessage
 
 User = get_user_model()
@@ -47,27 +49,50 @@ class SubjectConflictSolve(forms.Form):
     sub_likes = forms.ChoiceField(label="", required=False, widget=forms.Select(attrs={'class': SELECT_CLASS}))
 
     def __init__(self, *args, **kwargs):
-        if kwargs.get('initial'):
-            sim = kwargs.get('initial').get('likes_choices')
-            self.base_fields['sub_likes'].choices = [(_[1].id, _[1]) for _ in sim]
         super(SubjectConflictSolve, self).__init__(*args, **kwargs)
+        # варианты задаются копии поля в форме: base_fields общие для всех форм
+        sim = self.initial.get('likes_choices') or []
+        self.fields['sub_likes'].choices = [(_[1].id, _[1]) for _ in sim]
 
     def clean(self):
+        # совпадение с существующими дисциплинами проверяется сразу для всех форм в BaseSubjectFormSet
         cleaned_data = super().clean()
         if cleaned_data['is_create']:
             if not cleaned_data.get('subject'):
                 raise ValidationError({'subject': _('Нельзя создать дисциплину без названия')})
 
-            if Subject.objects.filter(subject=self.cleaned_data.get("subject")):
-                raise ValidationError({'subject': _('Такая дисциплина уже существует. Измените название дисциплины '
-                                                    'или свяжите с существующей')})
-
         else:
             if not cleaned_data.get("sub_likes"):
                 raise ValidationError({'sub_likes': _('Нельзя связать ни с какой дисциплиной. Пожалуйста, добавьте '
                                                       'новую')})
 
 
+def check_new_subjects(names: dict):
+    """ Проверяет названия новых дисциплин одним запросом
+    names : dict[номер строки: название]
+    ____________
+    формат выхода:
+    dict[номер строки: текст ошибки] - повторы среди новых названий и совпадения с существующими дисциплинами,
+    в том числе после нормализации
+    """
+    normal = FuzzySubjectsComparison.normal
+    errors = dict()
+    by_normal = dict()
+    for i, name in names.items():
+        if normal(name) in by_normal:
+            errors[i] = _('Нельзя создать две дисциплины с одним названием!')
+        else:
+            by_normal[normal(name)] = i
+
+    by_name = {name: i for i, name in names.items()}
+    for __, subject in FuzzySubjectsComparison.sameNormal(list(by_name)):
+        i = by_name.get(subject, by_normal.get(normal(subject)))
+        if i is not None:
+            errors.setdefault(i, _('Такая дисциплина уже существует: «%(subject)s». Измените название дисциплины '
+                                   'или свяжите с существующей') % dict(subject=subject))
+    return errors
+
+
 class PlanItemUpload(forms.Form):
     h_widget = forms.NumberInput(
         attrs={
@@ -132,11 +157,103 @@ class UploadFileForm(forms.Form):
     page = forms.ChoiceField(label="Страница из файла", required=True,
                              widget=forms.Select(attrs={'class': SELECT_CLASS}))
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # листы берутся из метаданных загруженного файла, а не из того, что прислал браузер
+        self.sheets_error = None
+        file = self.files.get(self.add_prefix('file'))
+        if file is not None:
+            try:
+                self.fields['page'].choices = [(_['name'], _['name']) for _ in sheets(file)]
+            except ValueError as e:
+                self.sheets_error = str(e)
+
+    def clean_file(self):
+        if self.sheets_error:
+            raise ValidationError(self.sheets_error)
+        return self.cleaned_data['file']
+
     def clean(self):
         super(UploadFileForm, self).clean()
         if Specialty.objects.filter(specialty=self.cleaned_data.get("specialty")):
             raise ValidationError({'specialty': _('Такая специальность уже существует. Измените название дисциплины '
                                                   'или свяжите с существующей')})
 
-    def set_page(self, page):
-        self.fields['page'].choices = [(page, page), ]
+
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """ Поле для выбора нескольких файлов, cleaned_data - список файлов """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        if isinstance(data, (list, tuple)):
+            return [super(MultipleFileField, self).clean(_, initial) for _ in data] or super().clean(None, initial)
+        return [super().clean(data, initial)]
+
+
+class BatchUploadForm(forms.Form):
+    prefix = 'batch'
+
+    files = MultipleFileField(label='')
+    faculty = forms.ModelChoiceField(label="Факультет", queryset=Faculty.objects.all(),
+                                     widget=forms.Select(attrs={'class': SELECT_CLASS}))
+    degree = forms.ModelChoiceField(label="Образовательный уровень", queryset=Degree.objects.all(),
+                                    widget=forms.Select(attrs={'class': SELECT_CLASS}))
+    rule = forms.ModelChoiceField(label="Правило по умолчанию", queryset=Rule.objects.all(),
+                                  widget=forms.Select(attrs={'class': SELECT_CLASS}))
+
+    def __init__(self, *args, items=None, **kwargs):
+        """ items : BatchItemFormSet | None - выбранные листы; без выбора (или при пустом наборе форм)
+        загружаются все листы файлов с правилом формы (см. batch.sheet_items) """
+        super().__init__(*args, **kwargs)
+        self.items = items
+
+    def clean(self):
+        super(BatchUploadForm, self).clean()
+        files = self.cleaned_data.get('files')
+        if not files:
+            return
+        sheets_of = []
+        for file in files:
+            try:
+                sheets_of.append({_['name'] for _ in sheets(file)})
+            except ValueError as e:
+                raise ValidationError({'files': f'{file.name}: {e}'})
+        if self.items is None or not self.items.total_form_count():
+            self.cleaned_data['selection'] = [None] * len(files)
+            return
+        if not self.items.is_valid():
+            raise ValidationError(_('Проверьте выбранные листы'))
+
+        # листы проверяются по метаданным загруженных файлов, а не по тому, что прислал браузер
+        selection = [[] for _ in files]
+        for item in self.items.cleaned_data:
+            if not item or not item['include']:
+                continue
+            if item['file'] >= len(files) or item['sheet'] not in sheets_of[item['file']]:
+                raise ValidationError(_('Лист «%(sheet)s» не найден в загруженных файлах'), params=item)
+            if not item['specialty']:
+                raise ValidationError(_('Укажите специальность для листа «%(sheet)s»'), params=item)
+            rule = item['rule'] or self.cleaned_data.get('rule')
+            selection[item['file']].append([item['sheet'], rule and rule.id, item['specialty']])
+        if not any(selection):
+            raise ValidationError(_('Не выбран ни один лист'))
+        self.cleaned_data['selection'] = selection
+
+
+class BatchItemForm(forms.Form):
+    """ Лист файла пакетной загрузки: file - номер файла в списке загруженных """
+    file = forms.IntegerField(min_value=0, widget=forms.HiddenInput())
+    sheet = forms.CharField(max_length=240, widget=forms.HiddenInput())
+    include = forms.BooleanField(label="Загрузить", required=False, initial=True)
+    specialty = forms.CharField(label="Специальность", max_length=240, required=False)
+    rule = forms.ModelChoiceField(label="Правило", queryset=Rule.objects.all(), required=False)
+
+
+BatchItemFormSet = forms.formset_factory(BatchItemForm, extra=0)
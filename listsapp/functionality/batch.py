@@ -0,0 +1,107 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import attr
+
+from listsapp.functionality import workbook
+
+
+def _init_worker():
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def _parse(item: tuple):
+    from listsapp.functionality.parser import Parser
+
+    return Parser(*item).parse()
+
+
+@attr.s(frozen=True)
+class BatchItem:
+    """ Один учебный план пакетной загрузки
+    file : str - имя файла
+    wsh : str - имя листа с планом
+    rule : json - правило парсинга листа
+    rule_id : int - id правила в базе
+    specialty : str - название новой специальности
+    """
+    file = attr.ib(type=str)
+    wsh = attr.ib(type=str)
+    rule = attr.ib(type=dict, repr=False)
+    rule_id = attr.ib(type=int)
+    specialty = attr.ib(type=str)
+
+
+def sheet_items(files: list, rule: dict, rule_id: int = None):
+    """ Планы пакетной загрузки
+    files : list[(имя файла на диске, исходное имя файла, выбранные листы)] - выбранные листы
+    list[[лист, id правила, специальность]]; None - все листы файла с правилом rule
+    ____________
+    без выбора название специальности - имя листа, а для файла с одним листом - исходное имя файла без расширения
+    """
+    from listsapp.models import Rule
+
+    rules = Rule.objects.in_bulk({_[1] for *__, selected in files for _ in selected or ()})
+    items = []
+    for file, name, selected in files:
+        if selected is None:
+            sheets = [_['name'] for _ in workbook.sheets(file)]
+            selected = [[sheet, rule_id, sheet if len(sheets) > 1 else os.path.splitext(os.path.basename(name))[0]]
+                        for sheet in sheets]
+        for sheet, sheet_rule_id, specialty in selected:
+            if sheet_rule_id in rules:
+                items.append(BatchItem(file, sheet, rules[sheet_rule_id].rule, sheet_rule_id, specialty))
+            else:
+                items.append(BatchItem(file, sheet, rule, rule_id, specialty))
+    return items
+
+
+def parse_batch(items: list, workers: int):
+    """ Parser.parse() для каждого BatchItem, в пуле из workers процессов
+    ____________
+    формат выхода:
+    list[dict] - результаты Parser.parse() в порядке items
+    """
+    tasks = [(_.file, _.wsh, _.rule, _.rule_id) for _ in items]
+    if workers <= 1 or len(tasks) <= 1:
+        return [_parse(_) for _ in tasks]
+    # spawn: задание выполняется в потоке веб-сервера, а fork многопоточного процесса может унаследовать
+    # захваченные другими потоками блокировки
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(_parse, tasks))
+
+
+def merge_batch(items: list, parsed: list):
+    """ Объединяет разобранные планы, чтобы общие дисциплины сравнивались и сопоставлялись один раз
+    ____________
+    формат выхода:
+    {"subjects": subjects, - дисциплины всех планов без повторов
+    "plans": [{"specialty": str, "exam": ..., "quiz": ..., "m_qu": ...}]} - строки планов как в Parser.parse(),
+    индекс предмета - индекс в общем списке subjects
+    """
+    subjects = dict()
+    plans = []
+    for item, data in zip(items, parsed):
+        position = [subjects.setdefault(_, len(subjects)) for _ in data['subjects']]
+        plan = dict(specialty=item.specialty)
+        for control in ('exam', 'quiz', 'm_qu'):
+            plan[control] = [[position[row[0]], *row[1:]] for row in data[control]]
+        plans.append(plan)
+    return dict(subjects=list(subjects), plans=plans)
+
+
+def drop_empty(items: list, parsed: list):
+    """ Убирает листы без дисциплин (титульный лист, график, примечания)
+    ____________
+    формат выхода:
+    (items, parsed, skipped: list[str]) - оставшиеся планы и их результаты Parser.parse(), пропущенные листы
+    """
+    kept = [(item, data) for item, data in zip(items, parsed) if data['subjects']]
+    skipped = [f'{_.specialty} (лист «{_.wsh}»)' for _, data in zip(items, parsed) if not data['subjects']]
+    return [_ for _, data in kept], [data for _, data in kept], skipped
@@ -1,6 +1,150 @@
-from django.db.models import QuerySet
+import hashlib
+import heapq
+import json
+import os
+import threading
+from array import array
+from collections import Counter, defaultdict, namedtuple
 
-from listsapp.models import Subject, AcademicPlan
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import QuerySet, Q
+
+from listsapp.functionality.versions import get_version
+from listsapp.models import Subject, AcademicPlan, SubjectTerms
+
+Terms = namedtuple('Terms', ['normal', 'words'])
+Terms.__doc__ = """ Нормализованное название и id его слов в словаре vocabulary (array('I')) """
+
+
+class WordPairCache:
+    """
+    Общий для процесса кэш результатов нечеткого сравнения пар слов
+    ____________
+    конструктор:
+    maxsize : int - наибольшее число хранимых пар
+    ____________
+    обращение идет без блокировки (операции dict атомарны под GIL), а при переполнении кэш очищается целиком,
+    поэтому попадание не платит за учет порядка использования. Ключ - только пара id слов словаря vocabulary:
+    после изменения NGRAM_LENGTH или THRESHOLD_WORD кэш нужно очистить
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = dict()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value):
+        if len(self._data) >= self.maxsize:
+            self._data.clear()
+        self._data[key] = value
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self):
+        return dict(size=len(self._data), maxsize=self.maxsize)
+
+
+word_pair_cache = WordPairCache(getattr(settings, 'SUBJECTS_WORD_CACHE_SIZE', 100000))
+
+
+class Vocabulary:
+    """
+    Общий для процесса словарь: нормализованное слово -> целочисленный id
+    ____________
+    для каждого id хранится отсортированный array('Q') упакованных в целые числа n-грамм слова (с повторами),
+    поэтому равенство слов и пересечение n-грамм сводятся к операциям над целыми числами.
+    В словарь входят только слова каталога (intern); слова загруженных названий, которых нет в каталоге,
+    получают временные id (temporary), которые освобождаются после сравнения (release)
+    """
+    CHAR_BITS = 21  # код любого символа Unicode помещается в 21 бит; n-грамма должна поместиться в 64 бита 'Q'
+
+    def __init__(self):
+        self.words = []  # id -> слово
+        self.grams = []  # id -> упакованные n-граммы
+        self._ids = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pack(gram: str):
+        value = 0
+        for c in gram:
+            value = value << Vocabulary.CHAR_BITS | ord(c)
+        return value
+
+    def intern(self, word: str, grams: dict = None):
+        """ id слова; grams - уже посчитанное мультимножество n-грамм слова """
+        i = self._ids.get(word)
+        if i is not None:
+            return i
+        if grams is None:
+            grams = Counter(FuzzySubjectsComparison.ngrams(word))
+        packed = array('Q', sorted(self.pack(g) for g, c in grams.items() for _ in range(c)))
+        with self._lock:
+            i = self._ids.get(word)
+            if i is None:
+                i = len(self.words)
+                self.words.append(word)
+                self.grams.append(packed)
+                self._ids[word] = i
+        return i
+
+    def temporary(self, word: str, scratch: dict):
+        """ id слова словаря или временный id слова не из словаря;
+        scratch - временные id одного сравнения: {слово: id}, см. release
+        """
+        i = self._ids.get(word, scratch.get(word))
+        if i is not None:
+            return i
+        packed = array('Q', sorted(self.pack(_) for _ in FuzzySubjectsComparison.ngrams(word)))
+        with self._lock:
+            i = len(self.words)
+            self.words.append(word)
+            self.grams.append(packed)
+        scratch[word] = i
+        return i
+
+    def release(self, scratch: dict):
+        """ Освобождает слова и n-граммы временных id. Сами id больше не выдаются,
+        поэтому записи word_pair_cache с ними не дают неверных ответов и вытесняются при переполнении кэша
+        """
+        with self._lock:
+            for i in scratch.values():
+                self.words[i] = self.grams[i] = None
+        scratch.clear()
+
+    def encode(self, words: list, grams: list = None, scratch: dict = None):
+        """ scratch - слова не из словаря получают временные id (см. temporary) """
+        if scratch is not None:
+            return array('I', [self.temporary(w, scratch) for w in words])
+        grams = grams or [None] * len(words)
+        return array('I', [self.intern(w, g) for w, g in zip(words, grams)])
+
+    def snapshot(self):
+        """ (words, grams) для load в другом процессе; временные id передаются пустыми """
+        with self._lock:
+            words = [w if w is not None and self._ids.get(w) == i else None for i, w in enumerate(self.words)]
+            grams = [g if w is not None else None for w, g in zip(words, self.grams)]
+        return words, grams
+
+    def load(self, words: list, grams: list):
+        """ Повторяет словарь другого процесса, чтобы id слов совпадали """
+        with self._lock:
+            for i, (w, g) in enumerate(zip(words, grams)):
+                if i < len(self.words):
+                    if self.words[i] != w:
+                        raise ValueError('Словарь процесса не совпадает с переданным')
+                    continue
+                self.words.append(w)
+                self.grams.append(g)
+                if w is not None:
+                    self._ids[w] = i
+
+
+vocabulary = Vocabulary()
 
 
 class FuzzySubjectsComparison:
@@ -9,6 +153,11 @@ class FuzzySubjectsComparison:
     ____________
     конструктор:
     compare_sub : list[str] - список названий дисциплин
+    backend : str - способ сравнения слов: 'python' или 'numpy' (пакетный, требует numpy и scipy),
+    по умолчанию settings.SUBJECTS_COMPARISON_BACKEND
+    workers : int - число процессов для сравнения, по умолчанию settings.SUBJECTS_COMPARISON_WORKERS,
+    не больше числа процессоров; списки короче PARALLEL_MIN_SUBJECTS сравниваются в текущем процессе.
+    Пул процессов со снимком каталога живет до изменения каталога (см. parallel.parallel_rank)
     ____________
     формат выхода:
     similar_sub : dict[ subject: similar_subjects ] - словарь с ключами-названиями дисциплин
@@ -17,137 +166,493 @@ class FuzzySubjectsComparison:
     MIN_WORLD_LENGTH = 3
     THRESHOLD_SENTENCE = 0.25
     THRESHOLD_WORD = 0.45
-    NGRAM_LENGTH = 2
+    NGRAM_LENGTH = 2  # не больше 3: n-грамма упаковывается в 64 бита по Vocabulary.CHAR_BITS на символ
+    BACKENDS = ('python', 'numpy')
+    PARALLEL_MIN_SUBJECTS = 50
+    CACHE_TIMEOUT = 60 * 60
 
-    def __init__(self, sub_to_compare: list):
+    def __init__(self, sub_to_compare: list, backend: str = None, workers: int = None):
         self.compare = sub_to_compare
-        self.current = Subject.objects.all()
+        self.current = Subject.objects.select_related('terms').all()
+        self.backend = backend or getattr(settings, 'SUBJECTS_COMPARISON_BACKEND', 'python')
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f'Неизвестный способ сравнения: {self.backend}')
+        self.workers = workers or getattr(settings, 'SUBJECTS_COMPARISON_WORKERS', 1)
+
+    def compareAll(self, k: int = None):
+        """ k - оставить для каждой дисциплины только k лучших совпадений """
+        f = FuzzySubjectsComparison
+        # версия читается до каталога: снимок в пуле процессов может быть только новее своей версии
+        version = get_version('subjects')
+        current = list(self.current)
+        current_terms = [f.subjectTerms(_) for _ in current]
 
-    def compareAll(self):
-        d = [
-            sorted(list(filter(lambda x: x[0] > 0, [(self.getFuzzyEqualValue(i, j.subject), j) for j in self.current])),
-                   key=lambda x: x[0], reverse=True)
-            for i in self.compare]
-        return d
+        workers = min(self.workers, os.cpu_count() or 1)
+        if workers > 1 and len(self.compare) >= self.PARALLEL_MIN_SUBJECTS:
+            from listsapp.functionality.parallel import parallel_rank
+
+            ranks = parallel_rank(current_terms, self.compare, self.backend, workers, version, k=k)
+        else:
+            scratch = dict()
+            try:
+                ranks = f.rankAll(SubjectIndex(current_terms), [f.terms(_, scratch) for _ in self.compare],
+                                  self.backend, k=k)
+            finally:
+                vocabulary.release(scratch)
+        return [[(v, current[p]) for v, p in rank] for rank in ranks]
+
+    def compareAllCached(self, k: int = None):
+        """ compareAll, результаты которого хранятся в кэше Django по хэшу списка дисциплин и версии каталога;
+        версия каталога меняется при сохранении и удалении Subject
+        """
+        digest = hashlib.sha256(json.dumps([self.compare, k], ensure_ascii=False).encode()).hexdigest()
+        key = f'subjects-matches:{get_version("subjects")}:{digest}'
+        ranks = cache.get(key)
+        if ranks is None:
+            d = self.compareAll(k=k)
+            cache.set(key, [[(v, s.id) for v, s in rank] for rank in d], self.CACHE_TIMEOUT)
+            return d
+
+        subjects = Subject.objects.in_bulk({i for rank in ranks for _, i in rank})
+        return [[(v, subjects[i]) for v, i in rank if i in subjects] for rank in ranks]
+
+    def resolveAll(self, k: int = None, threshold: float = None):
+        """ Сопоставление загружаемых дисциплин с каталогом до ручной проверки: совпадения после normal()
+        находятся одним запросом, нечеткое сравнение (compareAllCached) - только для остальных строк;
+        лучшее совпадение с оценкой не ниже threshold и без равных принимается сразу, только если названия
+        различаются опечатками (isSameWords): оценка 1.0 бывает и у разных дисциплин
+        ____________
+        threshold - по умолчанию SUBJECTS_AUTO_RESOLVE_THRESHOLD; если и она None - принимаются только точные совпадения
+        ____________
+        формат выхода:
+        (likes, decisions, pending):
+        likes - для каждой строки список пар [оценка, id] похожих дисциплин,
+        decisions - {str(номер строки): [False, id]} для сопоставленных автоматически,
+        pending - номера строк, оставленных для ручной проверки
+        """
+        f = FuzzySubjectsComparison
+        if threshold is None:
+            threshold = getattr(settings, 'SUBJECTS_AUTO_RESOLVE_THRESHOLD', None)
+        normals = [f.normal(_) for _ in self.compare]
+        exact = defaultdict(set)
+        for i, subject in f.sameNormal(self.compare):
+            exact[f.normal(subject)].add(i)
+
+        likes, decisions, rest = [[] for _ in self.compare], dict(), []
+        for i, normal in enumerate(normals):
+            ids = exact.get(normal) if normal else None
+            if ids is not None and len(ids) == 1:
+                likes[i] = [[1.0, next(iter(ids))]]
+                decisions[str(i)] = [False, likes[i][0][1]]
+            else:
+                rest.append(i)
+
+        pending = []
+        ranks = f([self.compare[i] for i in rest], backend=self.backend, workers=self.workers) \
+            .compareAllCached(k=k) if rest else []
+        for i, rank in zip(rest, ranks):
+            likes[i] = [[v, s.id] for v, s in rank]
+            if threshold is not None and rank and rank[0][0] >= threshold \
+                    and (len(rank) == 1 or rank[1][0] < rank[0][0]) \
+                    and f.isSameWords(self.compare[i], rank[0][1].subject):
+                decisions[str(i)] = [False, rank[0][1].id]
+            else:
+                pending.append(i)
+        return likes, decisions, pending
+
+    @staticmethod
+    def rankAll(index, compare_terms: list, backend: str, k: int = None, threshold: float = 0):
+        """ Оценки дисциплин индекса для каждого из compare_terms:
+        списки пар (оценка; позиция в индексе) с оценкой больше threshold по убыванию оценки,
+        при равных оценках - по позиции; при заданном k - только k первых пар
+        """
+        f = FuzzySubjectsComparison
+        similar, word_equal = None, f.isIdsFuzzyEqual
+        if backend == 'numpy':
+            from listsapp.functionality.vectorized import match_words
+
+            query = {w: vocabulary.grams[w] for t in compare_terms for w in t.words}
+            catalog = {w: vocabulary.grams[w] for w in index.words}
+            similar = match_words(query, catalog, f.THRESHOLD_WORD)
+            word_equal = lambda i, j: j in similar[i]
+
+        if k is None:
+            return [sorted(list(filter(lambda x: x[0] > threshold,
+                                       [(f.getTermsEqualValue(terms, index.subjects[p], word_equal), p)
+                                        for p in index.candidates(terms, similar)])),
+                           key=lambda x: x[0], reverse=True)
+                    for terms in compare_terms]
+        return [f.topK(index, terms, similar, word_equal, k, threshold) for terms in compare_terms]
+
+    @staticmethod
+    def topK(index, terms: Terms, similar: dict, word_equal, k: int, threshold: float):
+        """ k лучших пар (оценка; позиция в индексе) в том же порядке, что и у полного ранжирования
+        кандидаты, чья верхняя оценка по числу слов не лучше k-й найденной оценки, не сравниваются
+        """
+        f = FuzzySubjectsComparison
+        top = []  # куча (оценка, -позиция): в вершине худшая из k лучших пар
+        for p in index.candidates(terms, similar):
+            other = index.subjects[p]
+            if terms.normal == other.normal:
+                bound = 1.0
+            elif terms.words and other.words:
+                # число совпавших слов не больше длины короткого названия
+                bound = min(len(terms.words), len(other.words)) / max(len(terms.words), len(other.words))
+            else:
+                continue
+            # позиции идут по возрастанию, поэтому при равной оценке новый кандидат хуже уже найденных
+            if bound <= threshold or (len(top) == k and bound <= top[0][0]):
+                continue
+
+            value = f.getTermsEqualValue(terms, other, word_equal)
+            if value <= threshold:
+                continue
+            if len(top) < k:
+                heapq.heappush(top, (value, -p))
+            elif value > top[0][0]:
+                heapq.heapreplace(top, (value, -p))
+        return [(v, -p) for v, p in sorted(top, key=lambda x: (-x[0], -x[1]))]
 
     @staticmethod
     def normal(s: str):
         return "".join(c for c in s if c.isalnum()).lower()
 
+    @staticmethod
+    def sameNormal(names: list):
+        """ Существующие дисциплины, названия которых совпадают с одним из names после нормализации:
+        по SubjectTerms.normal, а для дисциплин без SubjectTerms (до update_subject_terms) - по названию
+        ____________
+        формат выхода:
+        list[(id, название)]
+        """
+        f = FuzzySubjectsComparison
+        normals = {f.normal(_) for _ in names}
+        rows = Subject.objects.filter(Q(subject__in=names) | Q(terms__normal__in=normals) | Q(terms__isnull=True)) \
+            .values_list('id', 'subject')
+        return [(i, subject) for i, subject in rows if f.normal(subject) in normals]
+
+    @staticmethod
+    def isSameWords(a: str, b: str):
+        """ Названия из тех же слов в том же порядке с точностью до одной опечатки в каждом слове;
+        в отличие от words() учитываются и короткие слова
+        """
+        f = FuzzySubjectsComparison
+        a, b = [f.normal(_) for _ in a.split()], [f.normal(_) for _ in b.split()]
+        a, b = [_ for _ in a if _], [_ for _ in b if _]
+        return len(a) == len(b) and all(f.isTypo(x, y) for x, y in zip(a, b))
+
+    @staticmethod
+    def isTypo(a: str, b: str):
+        """ Слова совпадают или отличаются одним пропущенным, лишним или замененным символом """
+        if a == b:
+            return True
+        if abs(len(a) - len(b)) > 1:
+            return False
+        if len(a) > len(b):
+            a, b = b, a
+        i = 0
+        while i < len(a) and a[i] == b[i]:
+            i += 1
+        return a[i + 1:] == b[i + 1:] if len(a) == len(b) else a[i:] == b[i + 1:]
+
     @staticmethod
     def words(s: str):
         f = FuzzySubjectsComparison
         return [f.normal(_) for _ in s.split(' ') if len(_) >= f.MIN_WORLD_LENGTH]
 
     @staticmethod
-    def isWordsFuzzyEqual(first: str, second: str):
+    def ngrams(word: str):
+        f = FuzzySubjectsComparison
+        return [word[i:i + f.NGRAM_LENGTH] for i in range(len(word) - f.NGRAM_LENGTH + 1)]
+
+    @staticmethod
+    def terms(s: str, scratch: dict = None):
+        """ scratch - слова не из словаря получают временные id (Vocabulary.temporary) """
+        f = FuzzySubjectsComparison
+        return Terms(f.normal(s), vocabulary.encode(f.words(s), scratch=scratch))
+
+    @staticmethod
+    def termsData(s: str):
+        """ Представление названия для сохранения в SubjectTerms """
+        f = FuzzySubjectsComparison
+        words = f.words(s)
+        return dict(normal=f.normal(s), words=words, grams=[dict(Counter(f.ngrams(w))) for w in words])
+
+    @staticmethod
+    def subjectTerms(subject: Subject):
+        """ Сохраненное представление дисциплины; для дисциплин без SubjectTerms вычисляется на месте """
+        try:
+            t = subject.terms
+        except SubjectTerms.DoesNotExist:
+            return FuzzySubjectsComparison.terms(subject.subject)
+        return Terms(t.normal, vocabulary.encode(t.words, t.grams))
+
+    @staticmethod
+    def sharedGrams(first: array, second: array):
+        """ Размер пересечения отсортированных мультимножеств упакованных n-грамм """
+        i = j = equal = 0
+        while i < len(first) and j < len(second):
+            if first[i] == second[j]:
+                equal += 1
+                i += 1
+                j += 1
+            elif first[i] < second[j]:
+                i += 1
+            else:
+                j += 1
+        return equal
+
+    @staticmethod
+    def isIdsFuzzyEqual(first: int, second: int):
         if first == second:
             return True
 
         f = FuzzySubjectsComparison
-        equalNgram = 0
-        first_gram_count = len(first) - f.NGRAM_LENGTH + 1
-        second_gram_count = len(second) - f.NGRAM_LENGTH + 1
-        used_ngram = [False for _ in range(second_gram_count)]
+        first_grams, second_grams = vocabulary.grams[first], vocabulary.grams[second]
+        first_gram_count, second_gram_count = len(first_grams), len(second_grams)
+        if not first_gram_count or not second_gram_count:
+            return False
+        # совпадений не больше, чем n-грамм в коротком слове
+        if min(first_gram_count, second_gram_count) / max(first_gram_count, second_gram_count) < f.THRESHOLD_WORD:
+            return False
 
-        for i in range(first_gram_count):
-            first_gram = first[i:i + f.NGRAM_LENGTH]
-            for j in range(second_gram_count):
-                if not used_ngram[j]:
-                    second_gram = second[j:j + f.NGRAM_LENGTH]
-                    if first_gram == second_gram:
-                        equalNgram += 1
-                        used_ngram[j] = True
-                        break
-        tanimoto = equalNgram / (first_gram_count + second_gram_count - equalNgram)
-        return tanimoto >= f.THRESHOLD_WORD
+        # сравнение симметрично, поэтому пара в кэше упорядочена; id слов - 32-битные (array('I'))
+        key = first << 32 | second if first < second else second << 32 | first
+        equal = word_pair_cache.get(key)
+        if equal is None:
+            # каждая n-грамма первого слова совпадает с неиспользованной n-граммой второго,
+            # поэтому число совпадений - размер пересечения мультимножеств
+            equalNgram = f.sharedGrams(first_grams, second_grams)
+            tanimoto = equalNgram / (first_gram_count + second_gram_count - equalNgram)
+            equal = tanimoto >= f.THRESHOLD_WORD
+            word_pair_cache.set(key, equal)
+        return equal
+
+    @staticmethod
+    def isWordsFuzzyEqual(first: str, second: str):
+        scratch = dict()
+        try:
+            return FuzzySubjectsComparison.isIdsFuzzyEqual(vocabulary.temporary(first, scratch),
+                                                           vocabulary.temporary(second, scratch))
+        finally:
+            vocabulary.release(scratch)
 
     @staticmethod
     def getFuzzyEqualValue(first: str, second: str):
         f = FuzzySubjectsComparison
-        if (not first and not second) or (f.normal(first) == f.normal(second)):
+        scratch = dict()
+        try:
+            return f.getTermsEqualValue(f.terms(first, scratch), f.terms(second, scratch))
+        finally:
+            vocabulary.release(scratch)
+
+    @staticmethod
+    def getTermsEqualValue(first: Terms, second: Terms, word_equal=None):
+        """ word_equal(first_id, second_id) - проверка нечеткого равенства слов, по умолчанию isIdsFuzzyEqual """
+        f = FuzzySubjectsComparison
+        word_equal = word_equal or f.isIdsFuzzyEqual
+        if first.normal == second.normal:
             return 1.0
 
-        if not first or not second:
+        if not first.words or not second.words:
             return 0.0
 
         equalWords = 0
-        first_words = f.words(first)
-        second_words = f.words(second)
-        used_words = [False for _ in range(len(second_words))]
+        used_words = [False for _ in range(len(second.words))]
 
-        for i in first_words:
-            for _, j in enumerate(second_words):
+        for i in first.words:
+            for _, j in enumerate(second.words):
                 if not used_words[_]:
-                    if f.isWordsFuzzyEqual(i, j):
+                    if word_equal(i, j):
                         equalWords += 1
                         used_words[_] = True
                         break
 
-        return equalWords / (len(first_words) + len(second_words) - equalWords)
+        return equalWords / (len(first.words) + len(second.words) - equalWords)
+
+
+# Vocabulary.pack хранит n-грамму в array('Q')
+assert FuzzySubjectsComparison.NGRAM_LENGTH * Vocabulary.CHAR_BITS <= 64, 'n-грамма не помещается в 64 бита'
+
+
+class SubjectIndex:
+    """
+    Инвертированный индекс названий дисциплин для отбора кандидатов на сравнение
+    ____________
+    конструктор:
+    subjects : list[Terms] - представления дисциплин каталога
+    ____________
+    candidates(terms) возвращает отсортированные позиции дисциплин из subjects, для которых
+    FuzzySubjectsComparison.getTermsEqualValue(terms, subject) > 0; остальные дисциплины сравнивать не нужно
+    """
+
+    def __init__(self, subjects: list):
+        self.subjects = subjects
+        self._normal = defaultdict(list)  # нормализованное название -> позиции дисциплин
+        self._words = defaultdict(list)  # id слова -> позиции дисциплин
+        self._grams = defaultdict(list)  # упакованная n-грамма -> пары (id слова, число вхождений в слово)
+
+        for pos, terms in enumerate(subjects):
+            self._normal[terms.normal].append(pos)
+            for w in terms.words:
+                positions = self._words[w]
+                if not positions:
+                    for g, c in Counter(vocabulary.grams[w]).items():
+                        self._grams[g].append((w, c))
+                if not positions or positions[-1] != pos:
+                    positions.append(pos)
+
+    @property
+    def words(self):
+        """ id слов, встречающихся в дисциплинах индекса """
+        return self._words.keys()
+
+    def similar_words(self, word: int):
+        """ id слов индекса, для которых FuzzySubjectsComparison.isIdsFuzzyEqual(word, w) истинно """
+        f = FuzzySubjectsComparison
+        similar = {word} if word in self._words else set()
+        grams = vocabulary.grams[word]
+
+        shared = Counter()
+        for g, c in Counter(grams).items():
+            for w, w_count in self._grams.get(g, ()):
+                shared[w] += min(c, w_count)
+
+        for w, equal_ngram in shared.items():
+            if equal_ngram / (len(grams) + len(vocabulary.grams[w]) - equal_ngram) >= f.THRESHOLD_WORD:
+                similar.add(w)
+        return similar
+
+    def candidates(self, terms: Terms, similar: dict = None):
+        """ Позиции дисциплин, у которых с terms совпадает нормализованное название или хотя бы одно слово
+        similar : dict[id: set[id]] - заранее найденные похожие слова индекса, например из match_words
+        """
+        positions = set(self._normal.get(terms.normal, ()))
+        for word in set(terms.words):
+            words = similar[word] if similar is not None else self.similar_words(word)
+            for w in words:
+                positions.update(self._words[w])
+        return sorted(positions)
 
 
 class AcademicDifferenceComparison:
+    """
+    Класс, реализующий расчет академической разницы при переводе на другую специальность
+    ____________
+    конструктор:
+    from_specialty, from_semester - текущая специальность и последний изученный семестр
+    to_specialty, to_semester - будущая специальность и семестр, на который выполняется перевод
+    ____________
+    формат выхода:
+    list[ dict(is_differ: bool, academic: AcademicPlan, deficit: int) ] - строки плана будущей специальности:
+    сначала общие дисциплины по id дисциплины, затем остальные; deficit - нехватка часов
+    """
     THRESHOLD_SENSITIVITY = 0.3
 
-    def __init__(self, from_specialty, from_semester, to_specialty, to_semester):
-        _from = AcademicPlan.objects.select_related('id_subject').filter(
-            id_specialty=from_specialty, semester__lte=from_semester)
-        _to = AcademicPlan.objects.select_related('id_subject').filter(
-            id_specialty=to_specialty, semester__lte=to_semester)
-        self._to_same = _to.filter(id_subject__in=_from.values('id_subject')).order_by('id_subject')
-        self._from_same = _from.filter(id_subject__in=_to.values('id_subject')).order_by('id_subject')
-        self._from_diff = _from.exclude(id__in=self._from_same)
-        self._to_diff = _to.exclude(id__in=self._to_same)
+    def __init__(self, from_specialty, from_semester, to_specialty, to_semester, plans: dict = None):
+        """ plans : dict[id специальности: list[AcademicPlan]] - уже загруженные планы (см. loadPlan),
+        чтобы не читать их заново для каждой пары семестров
+        """
+        from_semester, to_semester = int(from_semester), int(to_semester)
+        if plans is None:
+            # каждый план загружается одним запросом, дальше все считается в памяти
+            self._from = self.loadPlan(from_specialty, from_semester)
+            self._to = self.loadPlan(to_specialty, to_semester)
+        else:
+            self._from = [_ for _ in plans[getattr(from_specialty, 'id', from_specialty)] if _.semester <= from_semester]
+            self._to = [_ for _ in plans[getattr(to_specialty, 'id', to_specialty)] if _.semester <= to_semester]
+
+    @staticmethod
+    def loadPlan(specialty, semester: int = AcademicPlan.MAX_SEMESTER):
+        return list(AcademicPlan.objects.select_related('id_subject__terms').filter(
+            id_specialty=specialty, semester__lte=semester).order_by('id'))
+
+    @staticmethod
+    def hours(plan: AcademicPlan):
+        return plan.h_practice + plan.h_lecture + plan.h_laboratory
 
     def compare(self):
-        def hours(plan: AcademicPlan):
-            return plan.h_practice + plan.h_lecture + plan.h_laboratory
-
-        compare_same = [dict(is_differ=False, academic=t)
-                        if hours(f) - hours(t) > -1 else
-                        dict(is_differ=True, academic=t)
-                        for f, t in zip(self._from_same, self._to_same)]
-
-        f = FuzzySubjectsComparison
-
-        d = [sorted(
-                list(
-                    filter(
-                        lambda x: x[0] > self.THRESHOLD_SENSITIVITY,
-                        [(f.getFuzzyEqualValue(i.id_subject.subject, j.id_subject.subject), j)
-                         for j in self._from_diff]
-                    )
-                ),
-            key=lambda x: x[0], reverse=True)
-            for i in self._to_diff]
-
-        compare_diff = [
-            dict(is_differ=False, academic=t)
-            if len(f) and hours(f[0][1]) - hours(t) > -1 else
-            dict(is_differ=True, academic=t)
-            for f, t in zip(d, self._to_diff)
-        ]
+        return self.difference(self._from, self._to, self.bestMatches)
 
-        return compare_same + compare_diff
+    @classmethod
+    def compareTargets(cls, from_specialty, from_semester, to_semester=None):
+        """
+        Академическая разница текущей специальности со всеми остальными за один проход
+        ____________
+        to_semester - семестр перевода, по умолчанию равен from_semester
+        ____________
+        формат выхода:
+        list[ dict(specialty: Specialty, differ: int, deficit: int, difference: list) ] - по возрастанию
+        числа строк с академической разницей, затем суммарной нехватки часов
+        """
+        f = FuzzySubjectsComparison
+        from_semester = int(from_semester)
+        to_semester = int(to_semester or from_semester)
+        source = cls.loadPlan(from_specialty, from_semester)
+        targets = defaultdict(list)
+        for plan in AcademicPlan.objects.select_related('id_subject__terms', 'id_specialty').filter(
+                semester__lte=to_semester).exclude(id_specialty=from_specialty).order_by('id'):
+            targets[plan.id_specialty].append(plan)
+
+        # похожие дисциплины текущего плана ищутся один раз для каждой дисциплины всех целевых планов
+        index = SubjectIndex([f.subjectTerms(_.id_subject) for _ in source])
+        ranks = dict()
+
+        def best_matches(from_diff: list, to_diff: list):
+            new = {i.id_subject_id: i.id_subject for i in to_diff if i.id_subject_id not in ranks}
+            new_ranks = f.rankAll(index, [f.subjectTerms(_) for _ in new.values()], 'python',
+                                  threshold=cls.THRESHOLD_SENSITIVITY)
+            ranks.update(zip(new, new_ranks))
+            # from_diff - часть source в том же порядке, поэтому первая подходящая строка - лучшая в from_diff
+            allowed = {_.id for _ in from_diff}
+            return [next((source[p] for _, p in ranks[i.id_subject_id] if source[p].id in allowed), None)
+                    for i in to_diff]
 
+        result = []
+        for specialty, plan in targets.items():
+            difference = cls.difference(source, plan, best_matches)
+            result.append(dict(specialty=specialty, difference=difference,
+                               differ=sum(_['is_differ'] for _ in difference),
+                               deficit=sum(_['deficit'] for _ in difference)))
+        return sorted(result, key=lambda x: (x['differ'], x['deficit'], x['specialty'].id))
 
-if '__name__' == '__main__':
-    s = ['Иностранный язык', 'История', 'Философия', 'Иностранный язык в профессиональной сфере',
-         'Математика', 'Физика', 'Информатика и информационно-коммуникационные технологии',
-         'Правоведение', 'Экономика', 'Дискретная математика',
-         'Математическая логика',
-         'История науки и техники / Культурология', 'Методика преподавания / Педагогика',
-         'Социология и политология / Религиоведение', 'Операционные системы',
-         'Электротехника, электроника и схемотехника', 'Базы данных', 'Сети и телекоммуникации',
-         'Основы программирования', 'Безопасность жизнедеятельности', 'Основы охраны труда',
-         'Программирование', 'Web-программирование',
-         'СУБД Oracle', 'Объектно-ориентированное программирование',
-         'Современные информационные системы и технологии', 'Инженерная и компьютерная графика',
-         'Архитектура ЭВМ и микроконтроллеров', 'ЭВМ и периферийные устройства',
-         'Программирование в системе "1С: Предприятие" / Администрирование системы "1С: Предприятие" / Компьютерный дизайн',
-         'Вычислительная математика  / Численные методы /Вычислительные методы',
-         'Программирование робототехнических систем / Администрирование операционных систем /  Программные средства обработки графической информации',
-         'Интернет-технологии /  Аппаратные средства локальных сетей / Web-дизайн',
-         'Программирование в Unix / Администрирование распределённых систем / Компьютерная анимация и видео']
-    print(FuzzySubjectsComparison(s).compareAll())
+    @classmethod
+    def bestMatches(cls, from_diff: list, to_diff: list):
+        """ Для каждой строки to_diff - самая похожая строка from_diff с оценкой выше THRESHOLD_SENSITIVITY или None """
+        f = FuzzySubjectsComparison
+        index = SubjectIndex([f.subjectTerms(j.id_subject) for j in from_diff])
+        ranks = f.rankAll(index, [f.subjectTerms(i.id_subject) for i in to_diff], 'python',
+                          k=1, threshold=cls.THRESHOLD_SENSITIVITY)
+        return [from_diff[rank[0][1]] if rank else None for rank in ranks]
+
+    @classmethod
+    def row(cls, t: AcademicPlan, f: AcademicPlan = None):
+        """ Строка результата для строки t будущего плана; f - строка текущего плана, которая может быть зачтена """
+        deficit = cls.hours(t) - (cls.hours(f) if f is not None else 0)
+        return dict(is_differ=f is None or deficit >= 1, academic=t, deficit=max(deficit, 0))
+
+    @classmethod
+    def difference(cls, from_plan: list, to_plan: list, best_matches):
+        """ best_matches(from_diff, to_diff) - зачитываемые строки для дисциплин, которых нет в текущем плане """
+        from_by_subject = defaultdict(list)
+        for plan in sorted(from_plan, key=lambda x: x.semester):
+            from_by_subject[plan.id_subject_id].append(plan)
+        to_subjects = {plan.id_subject_id for plan in to_plan}
+
+        # строки одной дисциплины сопоставляются по порядку семестров;
+        # строке, которой не нашлось пары в текущем плане, нужна академическая разница
+        compare_same = []
+        paired = Counter()
+        for t in sorted((_ for _ in to_plan if _.id_subject_id in from_by_subject),
+                        key=lambda x: (x.id_subject_id, x.semester)):
+            rows = from_by_subject[t.id_subject_id]
+            i = paired[t.id_subject_id]
+            paired[t.id_subject_id] += 1
+            compare_same.append(cls.row(t, rows[i] if i < len(rows) else None))
+
+        # для решения о перезачете нужна только самая похожая дисциплина
+        from_diff = [_ for _ in from_plan if _.id_subject_id not in to_subjects]
+        to_diff = [_ for _ in to_plan if _.id_subject_id not in from_by_subject]
+        compare_diff = [cls.row(t, f) for t, f in zip(to_diff, best_matches(from_diff, to_diff))]
+
+        return compare_same + compare_diff
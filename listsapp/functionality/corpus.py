@@ -0,0 +1,95 @@
+import random
+
+MAX_LENGTH = 240  # Subject.subject
+
+# реальные названия дисциплин из учебного плана; остальные названия собираются из частей ниже
+SAMPLE_SUBJECTS = [
+    'Иностранный язык', 'История', 'Философия', 'Иностранный язык в профессиональной сфере',
+    'Математика', 'Физика', 'Информатика и информационно-коммуникационные технологии',
+    'Правоведение', 'Экономика', 'Дискретная математика',
+    'Математическая логика',
+    'История науки и техники / Культурология', 'Методика преподавания / Педагогика',
+    'Социология и политология / Религиоведение', 'Операционные системы',
+    'Электротехника, электроника и схемотехника', 'Базы данных', 'Сети и телекоммуникации',
+    'Основы программирования', 'Безопасность жизнедеятельности', 'Основы охраны труда',
+    'Программирование', 'Web-программирование',
+    'СУБД Oracle', 'Объектно-ориентированное программирование',
+    'Современные информационные системы и технологии', 'Инженерная и компьютерная графика',
+    'Архитектура ЭВМ и микроконтроллеров', 'ЭВМ и периферийные устройства',
+    'Программирование в системе "1С: Предприятие" / Администрирование системы "1С: Предприятие" / '
+    'Компьютерный дизайн',
+    'Вычислительная математика  / Численные методы /Вычислительные методы',
+    'Программирование робототехнических систем / Администрирование операционных систем /  '
+    'Программные средства обработки графической информации',
+    'Интернет-технологии /  Аппаратные средства локальных сетей / Web-дизайн',
+    'Программирование в Unix / Администрирование распределённых систем / Компьютерная анимация и видео',
+]
+
+PREFIXES = ['', '', '', 'Основы', 'Введение в', 'Теория', 'Методы', 'Практикум по', 'Технологии',
+            'Проектирование', 'Моделирование', 'Анализ', 'Администрирование', 'Специальные главы']
+ADJECTIVES = ['информационные', 'вычислительные', 'математическая', 'дискретная', 'прикладная', 'компьютерная',
+              'распределённые', 'операционные', 'интеллектуальные', 'экономическая', 'физическая',
+              'численные', 'объектно-ориентированное', 'системное', 'сетевые', 'встроенные', 'параллельные',
+              'профессиональная', 'инженерная', 'статистическая', 'линейная', 'аналитическая']
+NOUNS = ['системы', 'технологии', 'математика', 'программирование', 'логика', 'геометрия', 'алгебра',
+         'сети', 'базы данных', 'графика', 'электроника', 'схемотехника', 'механика', 'оптика', 'экономика',
+         'методы', 'вычисления', 'алгоритмы', 'модели', 'структуры данных', 'архитектура ЭВМ', 'микроконтроллеры',
+         'робототехника', 'криптография', 'безопасность', 'культурология', 'педагогика', 'психология']
+SUFFIXES = ['', '', '', '', 'в профессиональной сфере', 'и технологии', 'и системы', '(часть 1)', '(часть 2)',
+            'на языке Python', 'в Unix', 'реального времени', 'и их приложения', 'в экономике']
+
+
+class CurriculumCorpus:
+    """
+    Генератор правдоподобных названий дисциплин для замеров скорости сравнения
+    ____________
+    конструктор:
+    seed : int - зерно генератора, одинаковое зерно дает одинаковый корпус
+    """
+
+    def __init__(self, seed: int = 0):
+        self._random = random.Random(seed)
+
+    def name(self):
+        r = self._random
+        parts = [r.choice(PREFIXES), r.choice(ADJECTIVES), r.choice(NOUNS), r.choice(SUFFIXES)]
+        name = ' '.join(_ for _ in parts if _)
+        return name[0].upper() + name[1:]
+
+    def elective(self):
+        """ Дисциплина по выбору: несколько названий через косую черту """
+        return ' / '.join(self.name() for _ in range(self._random.randint(2, 3)))[:MAX_LENGTH]
+
+    def catalog(self, size: int):
+        """ size различных названий, начиная с реальных """
+        names = dict.fromkeys(SAMPLE_SUBJECTS[:size])
+        while len(names) < size:
+            names[self.elective() if self._random.random() < 0.1 else self.name()] = None
+        return list(names)
+
+    def plan(self, catalog: list, size: int, known: float = 0.7, typos: float = 0.3):
+        """ Учебный план из size названий: доля known взята из каталога (доля typos из них - с опечатками и
+        другим регистром), остальные - новые дисциплины
+        """
+        r = self._random
+        plan = []
+        for _ in range(size):
+            if r.random() < known:
+                name = r.choice(catalog)
+                if r.random() < typos:
+                    name = self.distort(name)
+            else:
+                name = self.name()
+            plan.append(name)
+        return plan
+
+    def distort(self, name: str):
+        """ Название с опечаткой, лишними пробелами или другим регистром """
+        r = self._random
+        kind = r.randrange(3)
+        if kind == 0 and len(name) > 4:
+            i = r.randrange(1, len(name) - 1)
+            return name[:i] + name[i + 1:]
+        if kind == 1:
+            return name.replace(' ', '  ', 1)
+        return name.lower()
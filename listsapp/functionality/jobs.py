@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils import timezone
+
+from listsapp.functionality import batch
+from listsapp.functionality.comparison import FuzzySubjectsComparison
+from listsapp.functionality.parser import Parser
+from listsapp.functionality.staging import staged_uploads
+from listsapp.models import UploadJob, Specialty
+
+log_jobs = logging.getLogger(__name__)
+
+
+class JobsLimitExceeded(Exception):
+    """ Незавершенных заданий уже столько, сколько разрешено """
+
+
+class UploadJobs:
+    """
+    Фоновые задания загрузки учебных планов в пуле потоков процесса веб-сервера, без внешнего брокера
+    ____________
+    конструктор:
+    workers : int - потоков для заданий; 0 - задание выполняется сразу в вызывающем потоке
+    limit : int - предельное число незавершенных заданий
+    timeout : int - секунд без изменений, после которых незавершенное задание считается брошенным
+    (например, после перезапуска сервера) и не учитывается в limit
+    batch_workers : int - процессов для разбора листов пакетной загрузки
+    ____________
+    состояние задания хранится в UploadJob: разбор файла, затем поиск похожих дисциплин
+    FuzzySubjectsComparison.resolveAll; результат сохраняется в StagedUpload для SubjectConflictView
+    """
+
+    def __init__(self, workers: int, limit: int, timeout: int, batch_workers: int = 1):
+        self._workers = workers
+        self._batch_workers = batch_workers
+        self._limit = limit
+        self._timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def active(self):
+        since = timezone.now() - timedelta(seconds=self._timeout)
+        return UploadJob.objects.filter(status__in=UploadJob.ACTIVE, updated__gte=since)
+
+    @staticmethod
+    def save_file(file):
+        return default_storage.save(f'uploads/{uuid4().hex}{os.path.splitext(file.name)[1]}', file)
+
+    def submit(self, user, file, page: str, rule, specialty: str, faculty, degree, k: int = None):
+        """ Сохраняет загруженный файл и ставит задание в очередь; k - число похожих дисциплин для каждой строки """
+        with self._lock:
+            if self.active().count() >= self._limit:
+                raise JobsLimitExceeded()
+            job = UploadJob.objects.create(user=user, file=self.save_file(file), page=page, id_rule=rule,
+                                           specialty=specialty, id_faculty=faculty, id_degree=degree)
+        return self.start(job, k)
+
+    def submit_batch(self, user, files: list, rule, faculty, degree, k: int = None, selection: list = None):
+        """ Пакетная загрузка: выбранные листы файлов (см. BatchUploadForm) - учебные планы новых специальностей;
+        без выбора - все листы с правилом rule. Файлы без выбранных листов не сохраняются
+        """
+        selection = selection or [None] * len(files)
+        with self._lock:
+            if self.active().count() >= self._limit:
+                raise JobsLimitExceeded()
+            job = UploadJob.objects.create(user=user, id_rule=rule, id_faculty=faculty, id_degree=degree,
+                                           specialty=', '.join(_.name for _ in files)[:240],
+                                           items=[[self.save_file(file), file.name, sheets]
+                                                  for file, sheets in zip(files, selection) if sheets != []])
+        return self.start(job, k)
+
+    def start(self, job: UploadJob, k: int = None):
+        if self._workers:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='upload')
+            self._executor.submit(self.run, job.id, k)
+        else:
+            self.run(job.id, k)
+        return job
+
+    @staticmethod
+    def update(job: UploadJob, status: str, progress: int):
+        job.status, job.progress = status, progress
+        job.save()
+
+    def expire(self, job: UploadJob):
+        """ Незавершенное задание без изменений дольше timeout брошено (например, сервер перезапущен
+        во время разбора) и отмечается как FAILED, чтобы страница задания перестала ждать его завершения
+        """
+        if job.status in UploadJob.ACTIVE and job.updated < timezone.now() - timedelta(seconds=self._timeout):
+            job.error = 'Задание прервано: его выполнение не продолжается. Загрузите файл заново'
+            self.update(job, UploadJob.FAILED, job.progress)
+        return job
+
+    def run(self, job_id: int, k: int = None):
+        job = UploadJob.objects.select_related('id_rule').get(id=job_id)
+        try:
+            self.update(job, UploadJob.PARSING, 10)
+            row_data = self.parse_batch(job) if job.items else self.parse_single(job)
+            self.update(job, UploadJob.MATCHING, 50)
+            likes, decisions, pending = FuzzySubjectsComparison(row_data['subjects']).resolveAll(k=k)
+            row_data.update(likes=likes, decisions=decisions, pending=pending)
+            row_data.update(faculty=job.id_faculty_id, degree=job.id_degree_id)
+            job.staged = staged_uploads.create(job.user, row_data)
+            self.update(job, UploadJob.DONE, 100)
+        except Exception as e:
+            log_jobs.exception('upload job %s failed', job_id)
+            job.error = str(e) or e.__class__.__name__
+            self.update(job, UploadJob.FAILED, job.progress)
+        finally:
+            for file in [job.file] + [_[0] for _ in job.items]:
+                if file:
+                    default_storage.delete(file)
+            if self._workers:
+                # соединение с базой принадлежит потоку пула и само не закрывается
+                connection.close()
+
+    @staticmethod
+    def parse_single(job: UploadJob):
+        row_data = Parser(default_storage.path(job.file), job.page, job.id_rule.rule, job.id_rule_id).parse()
+        row_data['specialty'] = job.specialty
+        return row_data
+
+    def parse_batch(self, job: UploadJob):
+        """ Разбирает листы параллельно; в row_data первый план, остальные - в row_data['batch'],
+        их сохраняет по очереди PlanItemsCreateView. Листы без дисциплин пропускаются и перечисляются
+        в row_data['skipped']
+        """
+        items = batch.sheet_items([(default_storage.path(file), name, sheets) for file, name, sheets in job.items],
+                                  job.id_rule.rule, job.id_rule_id)
+        items, parsed, skipped = batch.drop_empty(items, batch.parse_batch(items, self._batch_workers))
+        if not items:
+            raise ValueError(f"В листах нет дисциплин: {', '.join(skipped)}")
+        names = [_.specialty for _ in items]
+        duplicates = sorted({_ for _ in names if names.count(_) > 1} |
+                            set(Specialty.objects.filter(specialty__in=names).values_list('specialty', flat=True)))
+        if duplicates:
+            raise ValueError(f"Специальности уже существуют или повторяются: {', '.join(duplicates)}")
+
+        merged = batch.merge_batch(items, parsed)
+        first, *rest = merged['plans']
+        return dict(subjects=merged['subjects'], batch=rest, skipped=skipped, **first)
+
+
+upload_jobs = UploadJobs(getattr(settings, 'UPLOAD_JOBS_WORKERS', 2), getattr(settings, 'UPLOAD_JOBS_LIMIT', 4),
+                         getattr(settings, 'UPLOAD_JOBS_TIMEOUT', 60 * 60),
+                         getattr(settings, 'UPLOAD_BATCH_WORKERS', 2))
@@ -0,0 +1,167 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+
+from listsapp.functionality.comparison import AcademicDifferenceComparison
+from listsapp.functionality.versions import get_version, bump_version
+from listsapp.models import AcademicDifference, AcademicPlan, Specialty
+
+log_matrix = logging.getLogger(__name__)
+
+
+class AcademicDifferenceMatrix:
+    """
+    Хранилище рассчитанных академических разниц для всех пар специальностей и семестров
+    ____________
+    после изменения учебного плана строки специальности удаляются и пересчитываются в фоне
+    (см. models.drop_academic_differences и AcademicDifferenceRefresh); до пересчета недостающая строка
+    считается при обращении; перед хранилищем стоит кэш Django с ключами по версиям планов обеих специальностей.
+    Запись и удаление строк специальности выполняются под блокировкой ее строки Specialty
+    """
+    CACHE_TIMEOUT = 24 * 60 * 60
+
+    @staticmethod
+    def lock(specialties: list):
+        """ Блокирует строки специальностей до конца транзакции, всегда в порядке id """
+        list(Specialty.objects.select_for_update().filter(id__in=specialties).order_by('id').values_list('id'))
+
+    @staticmethod
+    def get(from_specialty, from_semester, to_specialty, to_semester):
+        """ Результат AcademicDifferenceComparison.compare() из кэша или хранилища;
+        при отсутствии - считается и сохраняется, если планы не изменились за время расчета
+        """
+        from_semester, to_semester = int(from_semester), int(to_semester)
+        from_id, to_id = getattr(from_specialty, 'id', from_specialty), getattr(to_specialty, 'id', to_specialty)
+        versions = get_version(f'plan:{from_id}'), get_version(f'plan:{to_id}')
+        key = f'academ:{from_id}:{from_semester}:{to_id}:{to_semester}:{versions[0]}:{versions[1]}'
+        difference = cache.get(key)
+        if difference is not None:
+            return difference
+
+        row = AcademicDifference.objects.filter(id_from_specialty=from_id, from_semester=from_semester,
+                                                id_to_specialty=to_id, to_semester=to_semester).first()
+        if row is None:
+            difference = AcademicDifferenceComparison(from_id, from_semester, to_id, to_semester).compare()
+            with transaction.atomic():
+                AcademicDifferenceMatrix.lock([from_id, to_id])
+                # invalidate меняет версии под той же блокировкой: если план изменился во время расчета,
+                # результат устарел и не сохраняется
+                if versions != (get_version(f'plan:{from_id}'), get_version(f'plan:{to_id}')):
+                    return difference
+                AcademicDifferenceMatrix.store(from_id, from_semester, to_id, to_semester, difference)
+        else:
+            plans = AcademicPlan.objects.select_related('id_subject').in_bulk([_[0] for _ in row.difference])
+            difference = [dict(is_differ=is_differ, academic=plans[i], deficit=deficit)
+                          for i, is_differ, deficit in row.difference if i in plans]
+        cache.set(key, difference, AcademicDifferenceMatrix.CACHE_TIMEOUT)
+        return difference
+
+    @staticmethod
+    def store(from_specialty, from_semester, to_specialty, to_semester, difference: list):
+        AcademicDifference.objects.update_or_create(
+            id_from_specialty_id=getattr(from_specialty, 'id', from_specialty), from_semester=from_semester,
+            id_to_specialty_id=getattr(to_specialty, 'id', to_specialty), to_semester=to_semester,
+            defaults=dict(difference=AcademicDifferenceMatrix.pack(difference)))
+
+    @staticmethod
+    def pack(difference: list):
+        return [[_['academic'].id, _['is_differ'], _['deficit']] for _ in difference]
+
+    @staticmethod
+    def invalidate(specialties: list):
+        """ Меняет версии планов специальностей и удаляет их сохраненные разницы """
+        with transaction.atomic():
+            AcademicDifferenceMatrix.lock(specialties)
+            bump_version(*[f'plan:{_}' for _ in specialties])
+            AcademicDifference.objects.filter(
+                models.Q(id_from_specialty__in=specialties) | models.Q(id_to_specialty__in=specialties)
+            ).delete()
+
+    @staticmethod
+    def build(specialties: list = None):
+        """ Пересчитывает разницы для всех пар специальностей, в которых участвует одна из specialties
+        (по умолчанию - для всех пар); возвращает число сохраненных строк.
+        Планы читаются под блокировкой specialties, поэтому изменение плана во время пересчета
+        дождется его окончания и снова сделает строки недействительными
+        """
+        count = 0
+        with transaction.atomic():
+            all_ids = list(Specialty.objects.values_list('id', flat=True))
+            changed = set(specialties) & set(all_ids) if specialties else set(all_ids)
+            AcademicDifferenceMatrix.lock(list(changed))
+            plans = {i: AcademicDifferenceComparison.loadPlan(i) for i in all_ids}
+            semesters = range(1, AcademicPlan.MAX_SEMESTER + 1)
+
+            stale = AcademicDifference.objects.all()
+            if specialties:
+                stale = stale.filter(id_from_specialty__in=changed) | stale.filter(id_to_specialty__in=changed)
+            stale.delete()
+            for from_id in all_ids:
+                rows = []
+                for to_id in all_ids:
+                    if from_id == to_id or (from_id not in changed and to_id not in changed):
+                        continue
+                    for from_semester in semesters:
+                        for to_semester in semesters:
+                            difference = AcademicDifferenceComparison(from_id, from_semester, to_id, to_semester,
+                                                                      plans=plans).compare()
+                            rows.append(AcademicDifference(
+                                id_from_specialty_id=from_id, from_semester=from_semester,
+                                id_to_specialty_id=to_id, to_semester=to_semester,
+                                difference=AcademicDifferenceMatrix.pack(difference)))
+                AcademicDifference.objects.bulk_create(rows, batch_size=500)
+                count += len(rows)
+        return count
+
+
+class AcademicDifferenceRefresh:
+    """
+    Пересчет сохраненных разниц специальностей после изменения их планов в фоновом потоке
+    ____________
+    конструктор:
+    workers : int - потоков пересчета; 0 - пересчет сразу в вызывающем потоке
+    ____________
+    специальности, измененные до начала очередного пересчета, пересчитываются вместе с ним,
+    поэтому серия изменений (например, построчное заполнение плана) не ставит пересчет на каждое изменение
+    """
+
+    def __init__(self, workers: int):
+        self._workers = workers
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, specialties: list):
+        if not self._workers:
+            return self.build(specialties)
+        with self._lock:
+            queued = bool(self._pending)
+            self._pending.update(specialties)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='academ')
+            if not queued:
+                self._executor.submit(self.run)
+
+    def run(self):
+        with self._lock:
+            specialties, self._pending = sorted(self._pending), set()
+        try:
+            self.build(specialties)
+        finally:
+            # соединение с базой принадлежит потоку пула и само не закрывается
+            connection.close()
+
+    @staticmethod
+    def build(specialties: list):
+        try:
+            AcademicDifferenceMatrix.build(specialties)
+        except Exception:
+            # строки уже удалены и будут посчитаны при обращении
+            log_matrix.exception('academic differences refresh failed for %s', specialties)
+
+
+academic_refresh = AcademicDifferenceRefresh(getattr(settings, 'ACADEMIC_DIFFERENCES_REFRESH_WORKERS', 1))
@@ -0,0 +1,79 @@
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# снимок каталога в процессе-обработчике, передается один раз при запуске процесса
+_index = None
+_backend = None
+
+# пул процессов переживает вызовы parallel_rank и пересоздается только для новой версии каталога
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker(words: list, grams: list, catalog: list, backend: str):
+    global _index, _backend
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    from listsapp.functionality.comparison import SubjectIndex, Terms, vocabulary
+
+    vocabulary.load(words, grams)
+    _index, _backend = SubjectIndex([Terms(*_) for _ in catalog]), backend
+
+
+def _rank_chunk(chunk: list, k: int = None):
+    from listsapp.functionality.comparison import FuzzySubjectsComparison, vocabulary
+
+    # представления названий строятся в процессе-обработчике: результат - позиции в каталоге,
+    # поэтому временные id слов не обязаны совпадать с id в вызывающем процессе
+    scratch = dict()
+    try:
+        return FuzzySubjectsComparison.rankAll(_index, [FuzzySubjectsComparison.terms(_, scratch) for _ in chunk],
+                                               _backend, k=k)
+    finally:
+        vocabulary.release(scratch)
+
+
+def _get_pool(key: tuple, catalog: list, backend: str, workers: int):
+    """ Пул с загруженным снимком каталога, вызывается под _pool_lock; для другой версии каталога
+    старый пул закрывается после завершения уже отправленных в него заданий """
+    global _pool, _pool_key
+    from listsapp.functionality.comparison import vocabulary
+
+    if _pool is None or _pool_key != key:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        # Terms передаются простыми кортежами: до django.setup() модуль comparison в процессе импортировать нельзя;
+        # id слов действительны только вместе со словарем, поэтому он передается вместе со снимком каталога
+        words, grams = vocabulary.snapshot()
+        # spawn: fork многопоточного процесса веб-сервера может унаследовать захваченные другими потоками блокировки
+        _pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                    initargs=(words, grams, [tuple(_) for _ in catalog], backend),
+                                    mp_context=multiprocessing.get_context('spawn'))
+        _pool_key = key
+    return _pool
+
+
+def parallel_rank(catalog: list, compare: list, backend: str, workers: int, version: str, k: int = None,
+                  chunks_per_worker: int = 4):
+    """ Параллельный FuzzySubjectsComparison.rankAll в пуле процессов
+    catalog : list[Terms] - представления дисциплин каталога
+    compare : list[str] - сравниваемые названия
+    version : str - версия каталога ('subjects'), прочитанная до загрузки catalog; пока она не меняется,
+    используется тот же пул, и каталог заново не передается
+    ____________
+    формат выхода:
+    list[ list[(оценка, позиция в catalog)] ] - в порядке compare
+    """
+    size = math.ceil(len(compare) / (workers * chunks_per_worker))
+    chunks = [compare[i:i + size] for i in range(0, len(compare), size)]
+    # map отправляет все задания сразу: под блокировкой пул не закроется до их отправки
+    with _pool_lock:
+        results = _get_pool((version, backend, workers), catalog, backend, workers).map(
+            _rank_chunk, chunks, [k] * len(chunks))
+    return [row for rows in results for row in rows]
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from pathlib import Path
+
+from django.conf import settings
+
+
+class ParsedWorkbookCache:
+    """
+    Дисковый кэш результатов Parser.parse() по содержимому файла
+    ____________
+    конструктор:
+    location : str - каталог для файлов кэша
+    max_size : int - предельный суммарный размер файлов в байтах, при превышении удаляются давно прочитанные
+    ____________
+    ключ - SHA-256 байтов файла, имя листа, id правила и хэш содержимого правила, поэтому повторная загрузка
+    того же файла не открывает его в openpyxl
+    """
+
+    def __init__(self, location, max_size: int):
+        self._location = Path(location)
+        self._max_size = max_size
+
+    @staticmethod
+    def fileDigest(file):
+        """ SHA-256 файла: имени файла на диске или загруженного файла Django """
+        digest = hashlib.sha256()
+        if hasattr(file, 'chunks'):
+            for chunk in file.chunks():
+                digest.update(chunk)
+            file.seek(0)
+        else:
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def key(cls, file, wsh: str, rule: dict, rule_id=None):
+        rule_digest = hashlib.sha256(json.dumps(rule, sort_keys=True).encode()).hexdigest()
+        return hashlib.sha256(f'{cls.fileDigest(file)}:{wsh}:{rule_id}:{rule_digest}'.encode()).hexdigest()
+
+    def _path(self, key: str):
+        return self._location / f'{key}.json.z'
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            data = json.loads(zlib.decompress(path.read_bytes()))
+            os.utime(path)
+        except (OSError, ValueError, zlib.error):
+            return None
+        return data
+
+    def set(self, key: str, data: dict):
+        self._location.mkdir(parents=True, exist_ok=True)
+        # у каждой записи свой временный файл: один ключ могут записывать несколько потоков и процессов
+        tmp = tempfile.NamedTemporaryFile(dir=self._location, prefix=f'{key}.', suffix='.tmp', delete=False)
+        try:
+            with tmp:
+                tmp.write(zlib.compress(json.dumps(data, ensure_ascii=False).encode()))
+            os.replace(tmp.name, self._path(key))
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+        self.cull()
+
+    def cull(self):
+        """ Удаляет давно прочитанные файлы, пока суммарный размер больше max_size """
+        files = []
+        for path in self._location.glob('*.json.z'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(_[1] for _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for path in self._location.glob('*.json.z'):
+            path.unlink(missing_ok=True)
+
+
+parsed_cache = ParsedWorkbookCache(getattr(settings, 'PARSER_CACHE_DIR',
+                                           Path(tempfile.gettempdir()) / 'examlists' / 'parsed'),
+                                   getattr(settings, 'PARSER_CACHE_MAX_SIZE', 64 * 1024 * 1024))
@@ -1,9 +1,14 @@
+import functools
+import json
 import logging
+import re
+from operator import itemgetter
 
 import attr
 from openpyxl import load_workbook
 from openpyxl.utils import column_index_from_string as indx
 
+from listsapp.functionality.parsecache import parsed_cache
 from listsapp.models import Subject
 
 log_xslx = logging.getLogger(__name__)
@@ -16,6 +21,7 @@ class Parser:
     file : str - имя файла для парсинга
     wsh : str - имя листа в файле, на которм находятся данные
     rule : json - правила, по которому нужно парсить
+    rule_id : int - id правила в базе, входит в ключ кэша разобранных файлов
     """
     # RULES = {'columns': {'cipher': 'A', 'subjects': 'B', 'departments': 'BG',
     #                                'controls': {'exam': 'C', 'quiz': 'D'},
@@ -27,6 +33,7 @@ class Parser:
     _file = attr.ib(type=str)
     _wsh = attr.ib(type=str)
     _rule = attr.ib(type=dict, repr=False)
+    _rule_id = attr.ib(type=int, default=None)
     _data = attr.ib(type=list, init=False, repr=False)
 
     def parse(self):
@@ -44,22 +51,30 @@ class Parser:
             """
 
         log_xslx.debug('start')
-        self.__load_data()
+        key = parsed_cache.key(self._file, self._wsh, self._rule, self._rule_id)
+        data = parsed_cache.get(key)
+        if data is None:
+            data = self.__clear_data(self.__load_data())
+            parsed_cache.set(key, data)
         log_xslx.debug('ending')
-        return self.__clear_data()
+        return data
 
     def __load_data(self):
-        """ Выгружает данные из xlsx-файла в кучу """
+        """ Построчно читает лист xlsx-файла и отдает только строки с предметами,
+        поэтому в памяти не держится весь лист; из строки берутся только колонки плана извлечения
+        """
         log_xslx.debug('start')
+        plan = ExtractionPlan.compile(self._rule)
         wb = load_workbook(filename=self._file, read_only=True, data_only=True)
-        sh = wb[self._wsh]
-        rows = sh.max_row
-        cols = self._rule['columns']['departments']
-        slc = sh['A1':f"{cols}{str(rows)}"]
-        self._data = [[str(_.value) for _ in s] for s in slc]
-        wb.close()
-        del slc, sh, wb
-        log_xslx.debug('end')
+        try:
+            sh = wb[self._wsh]
+            for row in sh.iter_rows(min_col=plan.min_col, max_col=plan.max_col, values_only=True):
+                row = [str(_) for _ in plan.project(row)]
+                if self.__is_subject(row, plan.cipher, plan.ciphers, plan.subject, plan.exam, plan.quiz):
+                    yield row
+        finally:
+            wb.close()
+            log_xslx.debug('end')
 
     @staticmethod
     def __is_subject(row: list, ciph, ciphers, subj, sem_exam, sem_quiz):
@@ -68,47 +83,95 @@ class Parser:
                and ((row[sem_exam] not in ('0', '', 'None', None)) \
                or (row[sem_quiz] not in ('0', '', 'None', None))))
 
-    def __clear_data(self):
-        """ Очищает данные, готовит словарь вида
+    def __clear_data(self, rows):
+        """ Собирает из строк с предметами словарь вида
         {"subjects": subjects, - список предметов
         "exam": exams, - список экзаменнационных предметов
         (индекс предмета, семестр, часы лекций, лабораторок, практики)
         "quiz": quiz, - список зачетных предметов (аналогично)
         "m_qu": main_quiz} - список предметов с диф.зачётом
         """
-        import re
-
         log_xslx.debug('start')
-        ciphers = self._rule['ciphers']
-        cols = self._rule['columns']
-        ciph, subj, deps = indx(cols['cipher']) - 1, indx(cols['subjects']) - 1, indx(cols['departments']) - 1
-        lec, lab, pract = cols['lectures'], cols['labs'], cols['practice']
-        f_sem = indx(cols['1_sem']) - 1
-        sem_exam = indx(cols['controls']['exam']) - 1
-        sem_quiz = indx(cols['controls']['quiz']) - 1
-
-        data = list(filter(lambda x: self.__is_subject(x, ciph, ciphers, subj, sem_exam, sem_quiz),
-                           self._data))
+        plan = ExtractionPlan.compile(self._rule)
+        data, subjects, exams, quiz, main_quiz = [], [], [], [], []
+        for i, row in enumerate(rows):
+            data.append(row)
+            subjects.append(row[plan.subject])
+            for s in re.split('[,.]', row[plan.exam]):
+                if s != 'None':
+                    exams.append(self.__plan_row(plan, row, i, s))
+            for s in re.split('[,.]', row[plan.quiz]):
+                if s != 'None' and s[-1] == '*':
+                    main_quiz.append(self.__plan_row(plan, row, i, s[0]))
+                elif s != 'None':
+                    quiz.append(self.__plan_row(plan, row, i, s))
         self._data = data
-        subjects = [_[subj] for _ in data]
-
-        l_d = len(data)
-        exams = [[i, s, data[i][f_sem + (int(s) - 1) * 4 + lec], data[i][f_sem + (int(s) - 1) * 4 + lab],
-                  data[i][f_sem + (int(s) - 1) * 4 + pract]]
-                 for i in range(l_d) for s in re.split('[,.]', data[i][sem_exam]) if s != 'None']
-        exams = [list(map(lambda x: int(x) if x != 'None' else 0, _)) for _ in exams]
-        quiz = [[i, s, data[i][f_sem + (int(s) - 1) * 4 + lec], data[i][f_sem + (int(s) - 1) * 4 + lab],
-                 data[i][f_sem + (int(s) - 1) * 4 + pract]]
-                for i in range(l_d) for s in re.split('[,.]', data[i][sem_quiz]) if s != 'None' and s[-1] != '*']
-        quiz = [list(map(lambda x: int(x) if x != 'None' else 0, _)) for _ in quiz]
-        main_quiz = [[i, s[0], data[i][f_sem + (int(s[0]) - 1) * 4 + lec], data[i][f_sem + (int(s[0]) - 1) * 4 + lab],
-                      data[i][f_sem + (int(s[0]) - 1) * 4 + pract]]
-                     for i in range(l_d) for s in re.split('[,.]', data[i][sem_quiz]) if s != 'None' and s[-1] == '*']
-        main_quiz = [list(map(lambda x: int(x) if x != 'None' else 0, _)) for _ in main_quiz]
 
         log_xslx.debug('end')
 
         return {"subjects": subjects,
                 "exam": exams, "quiz": quiz, "m_qu": main_quiz}
 
+    @staticmethod
+    def __plan_row(plan, row: list, i: int, s: str):
+        """ [индекс предмета, семестр, часы лекций, лабораторок, практики] """
+        return [int(x) if x != 'None' else 0 for x in (i, s, *(row[_] for _ in plan.hours[int(s)]))]
+
+
+@attr.s(frozen=True)
+class ExtractionPlan:
+    """ Скомпилированное правило парсинга: какие колонки листа читать и где в прочитанной строке лежат значения
+    конструктор:
+    через ExtractionPlan.compile(rule), планы кэшируются по содержимому правила
+    ____________
+    ciphers : tuple - допустимые шифры предметов
+    min_col, max_col : int - границы читаемых колонок листа (с единицы, как в openpyxl)
+    project : callable - выбирает из прочитанной строки нужные колонки
+    cipher, subject, exam, quiz : int - позиции колонок в выбранной строке
+    hours : dict[семестр: (лекции, лабораторные, практика)] - позиции колонок часов в выбранной строке
+    """
+    ciphers = attr.ib(type=tuple)
+    min_col = attr.ib(type=int)
+    max_col = attr.ib(type=int)
+    project = attr.ib(repr=False)
+    cipher = attr.ib(type=int)
+    subject = attr.ib(type=int)
+    exam = attr.ib(type=int)
+    quiz = attr.ib(type=int)
+    hours = attr.ib(type=dict, repr=False)
+
+    @classmethod
+    def compile(cls, rule: dict):
+        return cls.__compile(json.dumps(rule, sort_keys=True))
 
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def __compile(rule: str):
+        rule = json.loads(rule)
+        cols = rule['columns']
+        ciph, subj = indx(cols['cipher']) - 1, indx(cols['subjects']) - 1
+        # колонка кафедр не читается: она ограничивает блоки часов семестров
+        last = indx(cols['departments']) - 1
+        sem_exam, sem_quiz = indx(cols['controls']['exam']) - 1, indx(cols['controls']['quiz']) - 1
+        f_sem = indx(cols['1_sem']) - 1
+        shifts = cols['lectures'], cols['labs'], cols['practice']
+
+        # колонки часов семестра s: f_sem + (s - 1) * 4 + сдвиг; отрицательные индексы отсчитываются
+        # от конца строки до колонки кафедр, как при чтении всей строки
+        hours = dict()
+        s = 0
+        while True:
+            columns = [f_sem + (s - 1) * 4 + _ for _ in shifts]
+            if max(columns) > last:
+                break
+            hours[s] = [_ + last + 1 if _ < 0 else _ for _ in columns]
+            s += 1
+
+        needed = sorted({ciph, subj, sem_exam, sem_quiz, *(_ for h in hours.values() for _ in h)})
+        position = {col: p for p, col in enumerate(needed)}
+        getter = itemgetter(*(_ - needed[0] for _ in needed))
+        project = getter if len(needed) > 1 else lambda row: (getter(row),)
+        return ExtractionPlan(ciphers=tuple(rule['ciphers']), min_col=needed[0] + 1, max_col=needed[-1] + 1,
+                              project=project, cipher=position[ciph], subject=position[subj],
+                              exam=position[sem_exam], quiz=position[sem_quiz],
+                              hours={s: tuple(position[_] for _ in h) for s, h in hours.items()})
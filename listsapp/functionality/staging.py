@@ -0,0 +1,71 @@
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from listsapp.models import StagedUpload
+
+SESSION_KEY = 'upload'
+
+
+class StagedUploads:
+    """
+    Хранилище разобранных учебных планов между шагами загрузки
+    ____________
+    конструктор:
+    ttl : int - секунд без изменений, после которых загрузка считается брошенной и удаляется
+    ____________
+    row_data (см. Parser.parse) хранится в базе сжатым JSON, в сессии - только id загрузки,
+    поэтому шаги загрузки не перезаписывают сессию
+    """
+
+    def __init__(self, ttl: int):
+        self._ttl = ttl
+
+    @staticmethod
+    def encode(row_data: dict):
+        return zlib.compress(json.dumps(row_data, ensure_ascii=False, separators=(',', ':')).encode())
+
+    @staticmethod
+    def decode(data):
+        return json.loads(zlib.decompress(bytes(data)))
+
+    def actual(self):
+        return StagedUpload.objects.filter(updated__gte=timezone.now() - timedelta(seconds=self._ttl))
+
+    def create(self, user, row_data: dict):
+        StagedUpload.objects.filter(updated__lt=timezone.now() - timedelta(seconds=self._ttl)).delete()
+        return StagedUpload.objects.create(user=user, data=self.encode(row_data))
+
+    @staticmethod
+    def stage(request, staged: StagedUpload):
+        request.session[SESSION_KEY] = staged.id
+
+    def load(self, request, for_update: bool = False):
+        """ Загрузка из сессии пользователя; for_update - заблокировать строку до конца транзакции,
+        чтобы одновременные изменения row_data не перезаписывали друг друга (вызывать внутри transaction.atomic)
+        ____________
+        формат выхода:
+        (StagedUpload, row_data) или (None, None), если загрузки нет или она устарела
+        """
+        staged = self.actual().filter(id=request.session.get(SESSION_KEY), user=request.user)
+        if for_update:
+            staged = staged.select_for_update()
+        staged = staged.first()
+        if staged is None:
+            return None, None
+        return staged, self.decode(staged.data)
+
+    def save(self, staged: StagedUpload, row_data: dict):
+        staged.data = self.encode(row_data)
+        staged.save()
+
+    @staticmethod
+    def finish(request, staged: StagedUpload):
+        staged.delete()
+        request.session.pop(SESSION_KEY, None)
+
+
+staged_uploads = StagedUploads(getattr(settings, 'STAGED_UPLOAD_TTL', 24 * 60 * 60))
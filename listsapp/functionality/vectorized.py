@@ -0,0 +1,52 @@
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+
+def _encode(grams: list, features: dict, extend: bool):
+    """ Кодирует мультимножества n-грамм слов разреженной бинарной матрицей.
+    k-е вхождение n-граммы в слово - отдельный признак (n-грамма, k), поэтому скалярное
+    произведение строк равно размеру пересечения мультимножеств
+    """
+    rows, cols = [], []
+    for r, word_grams in enumerate(grams):
+        seen = Counter()
+        for g in word_grams:
+            feature = (g, seen[g])
+            seen[g] += 1
+            col = features.get(feature)
+            if col is None:
+                if not extend:
+                    continue
+                col = features[feature] = len(features)
+            rows.append(r)
+            cols.append(col)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                             shape=(len(grams), len(features)))
+
+
+def match_words(query: dict, catalog: dict, threshold: float):
+    """ Для каждого слова query находит слова catalog, нечетко равные ему по коэффициенту Танимото
+    query, catalog : dict[id слова: упакованные n-граммы слова с повторами]
+    ____________
+    формат выхода:
+    dict[ id: set[id слова catalog] ] - те же пары, что дает FuzzySubjectsComparison.isIdsFuzzyEqual
+    """
+    q_words, c_words = list(query), list(catalog)
+    q_grams, c_grams = list(query.values()), list(catalog.values())
+    features = dict()
+    q = _encode(q_grams, features, extend=True)
+    # признаки, которых нет в запросе, не влияют на пересечения
+    c = _encode(c_grams, features, extend=False)
+
+    equal = (q @ c.T).tocoo()
+    q_count = np.array([len(_) for _ in q_grams], dtype=np.int64)
+    c_count = np.array([len(_) for _ in c_grams], dtype=np.int64)
+    tanimoto = equal.data / (q_count[equal.row] + c_count[equal.col] - equal.data)
+    hit = tanimoto >= threshold
+
+    similar = {w: {w} if w in catalog else set() for w in q_words}
+    for r, col in zip(equal.row[hit], equal.col[hit]):
+        similar[q_words[r]].add(c_words[col])
+    return similar
@@ -0,0 +1,23 @@
+from uuid import uuid4
+
+from django.core.cache import cache
+
+
+def _key(name: str):
+    return f'version:{name}'
+
+
+def get_version(name: str):
+    """ Текущая версия набора данных name для ключей кэша.
+    Версия - случайный токен, поэтому после вытеснения из кэша старые ключи не оживают
+    """
+    version = cache.get(_key(name))
+    if version is None:
+        cache.add(_key(name), uuid4().hex, None)
+        version = cache.get(_key(name))
+    return version
+
+
+def bump_version(*names: str):
+    """ Делает недействительными все ключи кэша, построенные на текущих версиях names """
+    cache.set_many({_key(name): uuid4().hex for name in names}, None)
@@ -0,0 +1,59 @@
+import posixpath
+import zipfile
+from xml.etree.ElementTree import iterparse, ParseError
+
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DOC_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+OFFICE_DOCUMENT = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+
+def _relationships(archive: zipfile.ZipFile, part: str):
+    """ Связи части архива part: dict[Id: (Type, путь к части в архиве)] """
+    folder, name = posixpath.split(part)
+    relationships = dict()
+    with archive.open(posixpath.join(folder, '_rels', f'{name}.rels')) as f:
+        for _, el in iterparse(f):
+            if el.tag == f'{PKG_REL_NS}Relationship':
+                target = el.get('Target')
+                target = target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join(folder, target))
+                relationships[el.get('Id')] = (el.get('Type'), target)
+    return relationships
+
+
+def _dimension(archive: zipfile.ZipFile, part: str):
+    """ Диапазон листа из элемента dimension, который стоит перед данными ячеек """
+    with archive.open(part) as f:
+        for _, el in iterparse(f, events=('start',)):
+            if el.tag == f'{MAIN_NS}dimension':
+                return el.get('ref')
+            if el.tag == f'{MAIN_NS}sheetData':
+                return None
+    return None
+
+
+def sheets(file):
+    """ Листы xlsx-файла по метаданным архива, без чтения ячеек
+    file : str или файловый объект - имя файла или загруженный файл
+    ____________
+    формат выхода:
+    list[ dict(name: str, dimension: str или None) ] - в порядке листов книги, dimension вида "A1:BG301"
+    """
+    position = file.tell() if hasattr(file, 'tell') else None
+    try:
+        with zipfile.ZipFile(file) as archive:
+            book = next(target for kind, target in _relationships(archive, '').values() if kind == OFFICE_DOCUMENT)
+            parts = _relationships(archive, book)
+            result = []
+            with archive.open(book) as f:
+                for _, el in iterparse(f):
+                    if el.tag == f'{MAIN_NS}sheet':
+                        part = parts.get(el.get(f'{DOC_REL_NS}id'), (None, None))[1]
+                        result.append((el.get('name'), part))
+            return [dict(name=name, dimension=_dimension(archive, part) if part in archive.NameToInfo else None)
+                    for name, part in result]
+    except (zipfile.BadZipFile, KeyError, StopIteration, ParseError) as e:
+        raise ValueError('Файл не является книгой Excel в формате xlsx') from e
+    finally:
+        if position is not None:
+            file.seek(position)
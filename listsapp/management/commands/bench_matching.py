@@ -0,0 +1,121 @@
+import json
+import sys
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from listsapp.functionality.comparison import FuzzySubjectsComparison, AcademicDifferenceComparison, \
+    word_pair_cache
+from listsapp.functionality.corpus import CurriculumCorpus
+from listsapp.models import Subject, SubjectTerms, Degree, Faculty, Specialty, AcademicPlan
+
+
+class Command(BaseCommand):
+    help = 'Замеры скорости и памяти сравнения дисциплин на синтетическом корпусе во временной тестовой базе. ' \
+           'Результаты выводятся строками JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--catalog', type=int, nargs='+', default=[1000, 10000, 50000],
+                            help='размеры каталога дисциплин')
+        parser.add_argument('--plan', type=int, nargs='+', default=[50, 100, 200],
+                            help='число строк загружаемого плана')
+        parser.add_argument('--pairs', type=int, default=10000, help='число пар для getFuzzyEqualValue')
+        parser.add_argument('--repeat', type=int, default=3, help='повторов замера, берется лучшее время')
+        parser.add_argument('--backend', choices=FuzzySubjectsComparison.BACKENDS, default='python')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--k', type=int, default=None, help='число лучших совпадений в compareAll')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help='файл для результатов вместо stdout')
+
+    def handle(self, *args, **options):
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        test_db = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for size in options['catalog']:
+                corpus = CurriculumCorpus(options['seed'])
+                catalog = corpus.catalog(size)
+                self.fill_catalog(catalog)
+                for rows in options['plan']:
+                    for result in self.bench(corpus, catalog, rows, options):
+                        out.write(json.dumps(dict(catalog=size, plan=rows, **result), ensure_ascii=False) + '\n')
+                        out.flush()
+        finally:
+            connection.creation.destroy_test_db(test_db, verbosity=0)
+            if out is not sys.stdout:
+                out.close()
+
+    @staticmethod
+    def fill_catalog(catalog: list):
+        AcademicPlan.objects.all().delete()
+        Specialty.objects.all().delete()
+        SubjectTerms.objects.all().delete()
+        Subject.objects.all().delete()
+        subjects = Subject.objects.bulk_create([Subject(subject=_) for _ in catalog], batch_size=1000)
+        if subjects[0].pk is None:
+            subjects = list(Subject.objects.order_by('id'))
+        SubjectTerms.objects.bulk_create([SubjectTerms(id_subject=s, **FuzzySubjectsComparison.termsData(s.subject))
+                                          for s in subjects], batch_size=1000)
+
+    @staticmethod
+    def measure(func, repeat: int):
+        """ Лучшее время из repeat запусков и пик памяти Python отдельным запуском под tracemalloc """
+        seconds = None
+        for _ in range(repeat):
+            word_pair_cache.clear()
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        word_pair_cache.clear()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return dict(seconds=round(seconds, 6), peak_bytes=peak)
+
+    def bench(self, corpus: CurriculumCorpus, catalog: list, rows: int, options: dict):
+        plan = corpus.plan(catalog, rows)
+
+        # новый объект на каждый запуск: выборки из базы входят в замер
+        result = self.measure(lambda: FuzzySubjectsComparison(plan, backend=options['backend'],
+                                                              workers=options['workers']).compareAll(k=options['k']),
+                              options['repeat'])
+        yield dict(bench='compareAll', backend=options['backend'], workers=options['workers'], k=options['k'],
+                   rows_per_second=round(rows / result['seconds'], 2), **result)
+
+        pairs = [(plan[i % rows], catalog[i % len(catalog)]) for i in range(options['pairs'])]
+        result = self.measure(lambda: [FuzzySubjectsComparison.getFuzzyEqualValue(a, b) for a, b in pairs],
+                              options['repeat'])
+        yield dict(bench='getFuzzyEqualValue', pairs=len(pairs),
+                   pairs_per_second=round(len(pairs) / result['seconds'], 2), **result)
+
+        from_specialty, to_specialty = self.fill_plans(corpus, catalog, rows)
+        result = self.measure(lambda: AcademicDifferenceComparison(from_specialty, AcademicPlan.MAX_SEMESTER,
+                                                                   to_specialty, AcademicPlan.MAX_SEMESTER).compare(),
+                              options['repeat'])
+        yield dict(bench='AcademicDifferenceComparison.compare',
+                   rows_per_second=round(rows / result['seconds'], 2), **result)
+
+    @staticmethod
+    def fill_plans(corpus: CurriculumCorpus, catalog: list, rows: int):
+        """ Два учебных плана по rows строк из дисциплин каталога, примерно половина дисциплин общая """
+        AcademicPlan.objects.all().delete()
+        Specialty.objects.all().delete()
+        degree, _ = Degree.objects.get_or_create(degree='Бакалавриат')
+        faculty, _ = Faculty.objects.get_or_create(faculty='Факультет')
+        subjects = Subject.objects.in_bulk(field_name='subject')
+        shared = corpus.plan(catalog, rows // 2, known=1, typos=0)
+        specialties = []
+        for n in range(2):
+            specialty = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty=f'Специальность {n}')
+            names = shared + corpus.plan(catalog, rows - len(shared), known=1, typos=0)
+            AcademicPlan.objects.bulk_create([
+                AcademicPlan(semester=i % AcademicPlan.MAX_SEMESTER + 1, control=AcademicPlan.EXAM,
+                             id_specialty=specialty, id_subject=subjects[name],
+                             h_laboratory=i % 3, h_lecture=i % 4, h_practice=i % 2)
+                for i, name in enumerate(names)])
+            specialties.append(specialty.id)
+        return specialties
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from listsapp.functionality.matrix import AcademicDifferenceMatrix
+
+
+class Command(BaseCommand):
+    help = 'Рассчитывает и сохраняет академические разницы для всех пар специальностей и семестров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--specialty', type=int, nargs='+', default=None,
+                            help='пересчитать только пары с этими специальностями')
+
+    def handle(self, *args, **options):
+        count = AcademicDifferenceMatrix.build(options['specialty'])
+        self.stdout.write(self.style.SUCCESS(f'Сохранено разниц: {count}'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from listsapp.functionality.comparison import FuzzySubjectsComparison
+from listsapp.models import Subject, SubjectTerms
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает нормализованные представления названий всех дисциплин'
+
+    def handle(self, *args, **options):
+        f = FuzzySubjectsComparison
+        subjects = Subject.objects.all()
+        terms = []
+        for s in subjects:
+            terms.append(SubjectTerms(id_subject=s, **f.termsData(s.subject)))
+
+        with transaction.atomic():
+            SubjectTerms.objects.all().delete()
+            SubjectTerms.objects.bulk_create(terms)
+        self.stdout.write(self.style.SUCCESS(f'Обновлено дисциплин: {len(terms)}'))
@@ -1,8 +1,10 @@
+import threading
+
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser, User
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from schema import Schema, And, Use
@@ -38,6 +40,54 @@ class Subject(models.Model):
         return self.subject
 
 
+class SubjectTerms(models.Model):
+    """ Нормализованное представление названия дисциплины для нечеткого сравнения """
+    id_subject = models.OneToOneField('Subject', on_delete=models.CASCADE, related_name='terms')
+    normal = models.CharField(max_length=240, db_index=True)
+    words = models.JSONField(default=list)
+    grams = models.JSONField(default=list)
+
+    def __str__(self):
+        return self.normal
+
+
+@receiver([post_save, post_delete], sender=Subject)
+def bump_subjects_version(sender, **kwargs):
+    from listsapp.functionality.versions import bump_version
+
+    bump_version('subjects')
+
+
+@receiver(post_save, sender=Subject)
+def update_subject_terms(sender, instance, **kwargs):
+    from listsapp.functionality.comparison import FuzzySubjectsComparison
+
+    SubjectTerms.objects.update_or_create(id_subject=instance,
+                                          defaults=FuzzySubjectsComparison.termsData(instance.subject))
+
+
+def create_subjects(names: list):
+    """ Создает дисциплины с их SubjectTerms постоянным числом запросов
+    ____________
+    формат выхода:
+    dict[название: id дисциплины]
+    """
+    from listsapp.functionality.comparison import FuzzySubjectsComparison
+    from listsapp.functionality.versions import bump_version
+
+    if not names:
+        return dict()
+    with transaction.atomic():
+        Subject.objects.bulk_create([Subject(subject=_) for _ in names])
+        # MySQL не возвращает id из bulk_create, поэтому дисциплины читаются заново
+        subjects = Subject.objects.in_bulk(names, field_name='subject')
+        SubjectTerms.objects.bulk_create([SubjectTerms(id_subject=s, **FuzzySubjectsComparison.termsData(s.subject))
+                                          for s in subjects.values()])
+    # bulk_create не отправляет post_save, поэтому bump_subjects_version и update_subject_terms выполнены здесь
+    bump_version('subjects')
+    return {name: s.id for name, s in subjects.items()}
+
+
 class AcademicPlan(models.Model):
     EXAM = 'exam'
     QUIZ = 'quiz'
@@ -65,6 +115,58 @@ class AcademicPlan(models.Model):
             raise ValidationError({'semester': _(f'Максимальное значение для семестра равно {self.MAX_SEMESTER}')})
 
 
+class AcademicDifference(models.Model):
+    """ Сохраненный результат AcademicDifferenceComparison для пары специальностей и семестров """
+    id_from_specialty = models.ForeignKey('Specialty', on_delete=models.CASCADE, related_name='+')
+    from_semester = models.PositiveIntegerField()
+    id_to_specialty = models.ForeignKey('Specialty', on_delete=models.CASCADE, related_name='+')
+    to_semester = models.PositiveIntegerField()
+    difference = models.JSONField(default=list)  # тройки [id строки AcademicPlan, is_differ, deficit]
+
+    class Meta:
+        unique_together = [('id_from_specialty', 'from_semester', 'id_to_specialty', 'to_semester')]
+
+
+# специальности с измененными планами, ожидающие завершения транзакции, по потокам (соединениям с базой)
+_changed_specialties = threading.local()
+
+
+def drop_academic_differences(specialties: list):
+    """ Делает недействительными сохраненные и закэшированные академические разницы специальностей
+    после завершения текущей транзакции - один раз на специальность, сколько бы строк плана ни изменилось, -
+    и ставит их пересчет (см. functionality.matrix.AcademicDifferenceRefresh)
+    """
+    changed = _changed_specialties.__dict__.setdefault('ids', set())
+    changed.update(specialties)
+    transaction.on_commit(_apply_academic_changes)
+
+
+def _apply_academic_changes():
+    # первый из вызовов on_commit забирает все специальности транзакции, остальные ничего не делают
+    specialties = sorted(_changed_specialties.__dict__.pop('ids', ()))
+    if not specialties:
+        return
+    from listsapp.functionality.matrix import AcademicDifferenceMatrix, academic_refresh
+
+    AcademicDifferenceMatrix.invalidate(specialties)
+    academic_refresh.submit(specialties)
+
+
+@receiver([post_save, post_delete], sender=AcademicPlan)
+def academic_plan_changed(sender, instance, **kwargs):
+    drop_academic_differences([instance.id_specialty_id])
+
+
+@receiver(post_save, sender=Subject)
+def subject_changed(sender, instance, created, **kwargs):
+    # новое название меняет нечеткие совпадения во всех планах с этой дисциплиной;
+    # удалить дисциплину из плана нельзя (PROTECT), поэтому post_delete не нужен
+    if not created:
+        specialties = set(AcademicPlan.objects.filter(id_subject=instance).values_list('id_specialty', flat=True))
+        if specialties:
+            drop_academic_differences(list(specialties))
+
+
 class Group(models.Model):
     enter_year = models.PositiveIntegerField(default=2020)
     id_specialty = models.ForeignKey('Specialty', on_delete=models.PROTECT)
@@ -74,6 +176,22 @@ class Group(models.Model):
         return f"{self.name}-{self.enter_year} -- {self.id_specialty}"
 
 
+@receiver([post_save, post_delete], sender=Group)
+def bump_groups_version(sender, **kwargs):
+    from listsapp.functionality.versions import bump_version
+
+    bump_version('groups')
+
+
+@receiver([post_save, post_delete], sender=Specialty)
+@receiver([post_save, post_delete], sender=Faculty)
+def bump_specialties_version(sender, **kwargs):
+    # названия факультета и специальности входят в заголовки закэшированных списков дисциплин
+    from listsapp.functionality.versions import bump_version
+
+    bump_version('specialties')
+
+
 class Rule(models.Model):
     rule_name = models.CharField(max_length=120)
     rule = models.JSONField()
@@ -122,6 +240,50 @@ class Rule(models.Model):
             raise ValidationError({'rule': _(self.JSON_FORMAT_ERROR)})
 
 
+class StagedUpload(models.Model):
+    """ Разобранный учебный план между шагами загрузки (см. functionality.staging) """
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE)
+    data = models.BinaryField()  # row_data в JSON, сжатый zlib
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class UploadJob(models.Model):
+    """ Фоновый разбор загруженного учебного плана и поиск похожих дисциплин (см. functionality.jobs) """
+    PENDING = 'pending'
+    PARSING = 'parsing'
+    MATCHING = 'matching'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'В очереди'),
+        (PARSING, 'Разбор файла'),
+        (MATCHING, 'Поиск похожих дисциплин'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка')
+    ]
+    ACTIVE = (PENDING, PARSING, MATCHING)
+
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE)
+    status = models.CharField(max_length=8, choices=STATUSES, default=PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)
+    file = models.CharField(max_length=255)
+    page = models.CharField(max_length=240)
+    id_rule = models.ForeignKey('Rule', on_delete=models.CASCADE)
+    specialty = models.CharField(max_length=240)
+    id_faculty = models.ForeignKey('Faculty', on_delete=models.CASCADE)
+    id_degree = models.ForeignKey('Degree', on_delete=models.CASCADE)
+    # пакетная загрузка: [файл, исходное имя файла, выбранные листы [[лист, id правила, специальность]] или None]
+    items = models.JSONField(default=list)
+    staged = models.ForeignKey('StagedUpload', null=True, on_delete=models.SET_NULL)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.specialty} -- {self.get_status_display()}"
+
+
 class AdminMessage(models.Model):
     topic = models.CharField(max_length=120)
     mail = models.EmailField()
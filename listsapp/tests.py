@@ -1,3 +1,649 @@
-from django.test import TestCase
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import Workbook, load_workbook
+
+from listsapp.forms import UploadFileForm, BatchUploadForm, BatchItemFormSet, check_new_subjects
+from listsapp.functionality import batch, matrix, workbook
+from listsapp.functionality.comparison import FuzzySubjectsComparison, AcademicDifferenceComparison
+from listsapp.functionality.corpus import CurriculumCorpus
+from listsapp.functionality.jobs import UploadJobs, JobsLimitExceeded
+from listsapp.functionality.matrix import AcademicDifferenceMatrix, AcademicDifferenceRefresh
+from listsapp.functionality.parsecache import ParsedWorkbookCache
+from listsapp.functionality.parser import Parser
+from listsapp.functionality.staging import staged_uploads, SESSION_KEY
+from listsapp.functionality.versions import bump_version
+from listsapp.models import Degree, Faculty, Subject, SubjectTerms, AcademicPlan, Specialty, AcademicDifference, \
+    Group, Rule, StagedUpload, UploadJob, create_subjects
+from listsapp.views import cached_subjects_context, subjects_context, subjects_user_context
+
+try:
+    import numpy, scipy
+except ImportError:
+    numpy = None
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PlanItemsCreateViewTest(TestCase):
+    """ Сохранение учебного плана делает одно и то же число запросов при любом числе строк """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('staff', password='staff')
+        cls.faculty = Faculty.objects.create(faculty='Физтех')
+        cls.degree = Degree.objects.create(degree='Бакалавриат')
+        cls.subjects = [Subject.objects.create(subject=f'Дисциплина {i}') for i in range(60)]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def post_plan(self, rows: int, specialty: str):
+        row_data = dict(subjects=[_.id for _ in self.subjects[:rows]],
+                        exam=[[i, i % AcademicPlan.MAX_SEMESTER + 1, 1, 2, 3] for i in range(rows)], quiz=[], m_qu=[],
+                        specialty=specialty, faculty=self.faculty.id, degree=self.degree.id)
+        session = self.client.session
+        session[SESSION_KEY] = staged_uploads.create(self.user, row_data).id
+        session.save()
+
+        data = {'form-TOTAL_FORMS': rows, 'form-INITIAL_FORMS': rows}
+        for i, subject in enumerate(self.subjects[:rows]):
+            data.update({f'form-{i}-id_subject': subject.id, f'form-{i}-semester': i % AcademicPlan.MAX_SEMESTER + 1,
+                         f'form-{i}-h_lecture': 1, f'form-{i}-h_laboratory': 2, f'form-{i}-h_practice': 3,
+                         f'form-{i}-control': AcademicPlan.EXAM})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('upload_items'), data)
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        return len(queries)
+
+    def test_queries_do_not_depend_on_plan_size(self):
+        self.assertEqual(self.post_plan(5, 'Малый план'), self.post_plan(50, 'Большой план'))
+
+        specialty = Specialty.objects.get(specialty='Большой план')
+        self.assertEqual(AcademicPlan.objects.filter(id_specialty=specialty).count(), 50)
+
+    def test_batch_continues_with_next_plan(self):
+        """ После плана пакетной загрузки открывается следующий план, после последнего загрузка завершается """
+        subjects = [_.id for _ in self.subjects[:3]]
+        row_data = dict(subjects=subjects, exam=[[0, 1, 1, 2, 3], [1, 2, 1, 2, 3]], quiz=[], m_qu=[],
+                        specialty='Первый план', faculty=self.faculty.id, degree=self.degree.id,
+                        batch=[dict(specialty='Второй план', exam=[[2, 3, 4, 5, 6]], quiz=[], m_qu=[])])
+        staged = staged_uploads.create(self.user, row_data)
+        session = self.client.session
+        session[SESSION_KEY] = staged.id
+        session.save()
+
+        def rows(*items):
+            data = {'form-TOTAL_FORMS': len(items), 'form-INITIAL_FORMS': len(items)}
+            for i, (subject, semester) in enumerate(items):
+                data.update({f'form-{i}-id_subject': subject, f'form-{i}-semester': semester,
+                             f'form-{i}-h_lecture': 1, f'form-{i}-h_laboratory': 2, f'form-{i}-h_practice': 3,
+                             f'form-{i}-control': AcademicPlan.EXAM})
+            return data
+
+        response = self.client.post(reverse('upload_items'), rows((subjects[0], 1), (subjects[1], 2)))
+        self.assertRedirects(response, reverse('upload_items'), fetch_redirect_response=False)
+        self.assertEqual(AcademicPlan.objects.filter(id_specialty__specialty='Первый план').count(), 2)
+        self.assertEqual(staged_uploads.decode(StagedUpload.objects.get(id=staged.id).data)['specialty'],
+                         'Второй план')
+
+        response = self.client.post(reverse('upload_items'), rows((subjects[2], 3)))
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertEqual(list(AcademicPlan.objects.filter(id_specialty__specialty='Второй план')
+                              .values_list('id_subject', 'semester')), [(subjects[2], 3)])
+        self.assertFalse(StagedUpload.objects.filter(id=staged.id).exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FuzzySubjectsComparisonTest(TestCase):
+    """ Ранжирование через индекс каталога и отбор k лучших совпадают с полным перебором getFuzzyEqualValue """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.corpus = CurriculumCorpus(seed=7)
+        create_subjects(cls.corpus.catalog(300))
+
+    def brute_force(self, comparison: FuzzySubjectsComparison):
+        current = list(comparison.current)
+        return [[(v, s.id) for v, s in sorted(((FuzzySubjectsComparison.getFuzzyEqualValue(name, s.subject), s)
+                                               for s in current), key=lambda _: _[0], reverse=True) if v > 0]
+                for name in comparison.compare]
+
+    def assertSameRanking(self, backend: str):
+        plan = self.corpus.plan(list(Subject.objects.values_list('subject', flat=True)), 40)
+        comparison = FuzzySubjectsComparison(plan, backend=backend)
+        expected = self.brute_force(comparison)
+        self.assertTrue(any(len(rank) > 5 for rank in expected))
+        self.assertEqual([[(v, s.id) for v, s in rank] for rank in comparison.compareAll()], expected)
+        self.assertEqual([[(v, s.id) for v, s in rank] for rank in comparison.compareAll(k=5)],
+                         [rank[:5] for rank in expected])
+
+    def test_python_backend(self):
+        self.assertSameRanking('python')
+
+    @skipIf(numpy is None, 'numpy и scipy не установлены')
+    def test_numpy_backend(self):
+        self.assertSameRanking('numpy')
+
+
+class StagedUploadsTest(TestCase):
+    """ Устаревшие загрузки удаляются, а шаги загрузки без действующей загрузки возвращают к выбору файла """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('staff', password='staff')
+        cls.row_data = dict(subjects=['Математика'], exam=[[0, 1, 1, 2, 3]], quiz=[], m_qu=[], specialty='Информатика')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def expire(self, staged: StagedUpload):
+        # update не меняет поле auto_now
+        StagedUpload.objects.filter(id=staged.id).update(updated=timezone.now() - timedelta(days=2))
+
+    def stage(self, staged_id: int):
+        session = self.client.session
+        session[SESSION_KEY] = staged_id
+        session.save()
+
+    def test_expired_upload_is_removed(self):
+        old = staged_uploads.create(self.user, self.row_data)
+        self.expire(old)
+        self.assertFalse(staged_uploads.actual().filter(id=old.id).exists())
+
+        new = staged_uploads.create(self.user, self.row_data)
+        self.assertEqual(list(StagedUpload.objects.values_list('id', flat=True)), [new.id])
+        self.assertEqual(staged_uploads.decode(new.data), self.row_data)
+
+    def test_missing_or_expired_upload_returns_to_upload_step(self):
+        staged = staged_uploads.create(self.user, self.row_data)
+        self.expire(staged)
+        for staged_id in (staged.id, staged.id + 1):
+            self.stage(staged_id)
+            for name in ('upload_items', 'upload_conflicts'):
+                self.assertRedirects(self.client.get(reverse(name)), reverse('upload'),
+                                     fetch_redirect_response=False)
+                self.assertRedirects(self.client.post(reverse(name), {}), reverse('upload'),
+                                     fetch_redirect_response=False)
+
+
+class CheckNewSubjectsTest(TestCase):
+    """ Новые названия проверяются на повторы и на совпадение с каталогом после нормализации,
+    в том числе с дисциплинами без SubjectTerms """
+
+    @classmethod
+    def setUpTestData(cls):
+        create_subjects(['Математический анализ', 'Физика'])
+        legacy = Subject.objects.create(subject='История России')
+        SubjectTerms.objects.filter(id_subject=legacy).delete()
+
+    def test_check_new_subjects(self):
+        errors = check_new_subjects({0: 'математический  анализ', 1: 'Базы данных', 2: 'Базы-данных',
+                                     3: 'История России.', 4: 'Физика', 5: 'Программирование'})
+        self.assertEqual(sorted(errors), [0, 2, 3, 4])
+        self.assertIn('Нельзя создать две дисциплины', str(errors[2]))
+        self.assertIn('«История России»', str(errors[3]))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ResolveAllTest(TestCase):
+    """ Точные совпадения после нормализации и опечатки в лучшем совпадении сопоставляются без проверки """
+
+    @classmethod
+    def setUpTestData(cls):
+        ids = create_subjects(['Математический анализ', 'Физика', 'Основы программирования'])
+        cls.analysis, cls.programming = ids['Математический анализ'], ids['Основы программирования']
+        cls.history = Subject.objects.create(subject='История России').id
+        SubjectTerms.objects.filter(id_subject=cls.history).delete()
+        # две дисциплины с одним нормализованным названием - точного совпадения нет
+        create_subjects(['Философия'])
+        Subject.objects.create(subject='Философия.')
+
+    def test_exact_matches(self):
+        likes, decisions, pending = FuzzySubjectsComparison(
+            ['математический  анализ', 'История России!', 'Философия', 'Экономика']).resolveAll(k=3, threshold=None)
+        self.assertEqual(decisions, {'0': [False, self.analysis], '1': [False, self.history]})
+        self.assertEqual(likes[0], [[1.0, self.analysis]])
+        self.assertEqual(pending, [2, 3])
+        self.assertEqual(len(likes[2]), 2)
+
+    def test_typo_matches(self):
+        names = ['Математический анализз', 'Основы програмирования', 'Основы алгоритмизации']
+        likes, decisions, pending = FuzzySubjectsComparison(names).resolveAll(k=3, threshold=0.5)
+        self.assertEqual(decisions, {'0': [False, self.analysis], '1': [False, self.programming]})
+        self.assertEqual(pending, [2])
+        self.assertEqual(likes[2][0][1], self.programming)
+
+        # без порога опечатки остаются для ручной проверки
+        likes, decisions, pending = FuzzySubjectsComparison(names).resolveAll(k=3, threshold=None)
+        self.assertEqual((decisions, pending), ({}, [0, 1, 2]))
+
+
+class TemporaryDirMixin:
+    """ self.dir - временный каталог теста; кэш разобранных файлов - в нем же """
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        patcher = mock.patch('listsapp.functionality.parser.parsed_cache',
+                             ParsedWorkbookCache(os.path.join(self.dir.name, 'parsed'), 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class ParserTest(TemporaryDirMixin, TestCase):
+    """ Разбор листа по правилу: экзамены, зачеты и диф. зачеты (*) с часами своих семестров """
+    RULE = {'columns': {'cipher': 'A', 'subjects': 'B', 'departments': 'BG', 'controls': {'exam': 'C', 'quiz': 'D'},
+                        '1_sem': 'R', 'lectures': 1, 'practice': 2, 'labs': 3},
+            'ciphers': ['ОНБ', 'ПБ']}
+
+    @staticmethod
+    def row(cipher, subject, exam, quiz, hours: dict):
+        """ hours - {семестр: (лекции, практика, лабораторные)}; часы семестра s начинаются с колонки S + (s - 1) * 4 """
+        row = [cipher, subject, exam, quiz] + [None] * 55
+        for s, values in hours.items():
+            for shift, value in zip((1, 2, 3), values):
+                row[17 + (s - 1) * 4 + shift] = value
+        return row
+
+    @staticmethod
+    def workbook(directory: str):
+        """ Лист «План» с дисциплинами Математика, Физика и Экономика (см. test_parse) """
+        wb = Workbook()
+        sh = wb.active
+        sh.title = 'План'
+        sh.append(['Шифр', 'Дисциплина', 'Экзамены', 'Зачеты'])
+        sh.append(ParserTest.row('ОНБ.1', 'Математика', '1,2', None, {1: (10, 20, 30), 2: (11, 21, None)}))
+        sh.append(ParserTest.row('ПБ.2', 'Физика', None, '2,3*', {2: (12, 22, 32), 3: (13, 23, 33)}))
+        sh.append(ParserTest.row('ОНБ.3', 'Без контроля', None, None, {1: (1, 2, 3)}))
+        sh.append(ParserTest.row('ФТД.1', 'Факультатив', 1, None, {1: (1, 2, 3)}))
+        sh.append(ParserTest.row('ПБ.4', 'Экономика', 4, '4', {4: (14, None, 34)}))
+        file = os.path.join(directory, 'plan.xlsx')
+        wb.save(file)
+        return file
+
+    def test_parse(self):
+        file = self.workbook(self.dir.name)
+        # строки плана: [индекс предмета, семестр, лекции, лабораторные, практика]
+        self.assertEqual(Parser(file, 'План', self.RULE).parse(), {
+            'subjects': ['Математика', 'Физика', 'Экономика'],
+            'exam': [[0, 1, 10, 30, 20], [0, 2, 11, 0, 21], [2, 4, 14, 34, 0]],
+            'quiz': [[1, 2, 12, 32, 22], [2, 4, 14, 34, 0]],
+            'm_qu': [[1, 3, 13, 33, 23]],
+        })
+
+    def test_parsed_cache(self):
+        """ Повторный разбор того же листа по тому же правилу не открывает файл; другое правило или id - промах """
+        file = self.workbook(self.dir.name)
+        data = Parser(file, 'План', self.RULE, 1).parse()
+        with mock.patch('listsapp.functionality.parser.load_workbook', wraps=load_workbook) as load:
+            self.assertEqual(Parser(file, 'План', self.RULE, 1).parse(), data)
+            load.assert_not_called()
+
+            self.assertEqual(Parser(file, 'План', dict(self.RULE, ciphers=['ОНБ']), 1).parse()['subjects'],
+                             ['Математика'])
+            self.assertEqual(Parser(file, 'План', self.RULE, 2).parse(), data)
+            self.assertEqual(load.call_count, 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir.name, 'parsed'))), 3)
+
+
+class WorkbookTest(TemporaryDirMixin, TestCase):
+    """ Листы книги читаются из метаданных архива; форма загрузки принимает только лист из загруженного файла """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rule = Rule.objects.create(rule_name='Физтех', rule=ParserTest.RULE)
+        cls.faculty = Faculty.objects.create(faculty='Физтех')
+        cls.degree = Degree.objects.create(degree='Бакалавриат')
+
+    def setUp(self):
+        super().setUp()
+        wb = Workbook()
+        wb.active.title = 'Титул'
+        wb.active.append(['Учебный план'])
+        sh = wb.create_sheet('План')
+        sh.append(['Шифр', 'Дисциплина', 'Экзамены'])
+        sh.append(['ОНБ.1', 'Математика', '1'])
+        wb.create_sheet('График')
+        self.file = os.path.join(self.dir.name, 'plans.xlsx')
+        wb.save(self.file)
+
+    def upload(self, content: bytes = None):
+        if content is None:
+            with open(self.file, 'rb') as f:
+                content = f.read()
+        return SimpleUploadedFile('plans.xlsx', content)
+
+    def test_sheets(self):
+        expected = [dict(name='Титул', dimension='A1:A1'), dict(name='План', dimension='A1:C2'),
+                    dict(name='График', dimension='A1:A1')]
+        self.assertEqual(workbook.sheets(self.file), expected)
+
+        file = self.upload()
+        file.seek(5)
+        self.assertEqual(workbook.sheets(file), expected)
+        self.assertEqual(file.tell(), 5)
+
+        with self.assertRaises(ValueError):
+            workbook.sheets(self.upload(b'not a workbook'))
+
+    def form(self, page: str, content: bytes = None):
+        data = {'upload-specialty': 'Информатика', 'upload-faculty': self.faculty.id,
+                'upload-degree': self.degree.id, 'upload-rule': self.rule.id, 'upload-page': page}
+        return UploadFileForm(data, {'upload-file': self.upload(content)})
+
+    def test_upload_form_pages(self):
+        form = self.form('План')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual([_[0] for _ in form.fields['page'].choices], ['Титул', 'План', 'График'])
+
+        form = self.form('Лист1')
+        self.assertFalse(form.is_valid())
+        self.assertIn('page', form.errors)
+
+        form = self.form('План', b'not a workbook')
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['file'], ['Файл не является книгой Excel в формате xlsx'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class UploadJobsTest(TemporaryDirMixin, TestCase):
+    """ Задания загрузки, выполняемые в вызывающем потоке (workers=0) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('staff', password='staff')
+        cls.rule = Rule.objects.create(rule_name='Физтех', rule=ParserTest.RULE)
+        cls.faculty = Faculty.objects.create(faculty='Физтех')
+        cls.degree = Degree.objects.create(degree='Бакалавриат')
+        create_subjects(['Математика'])
+
+    def setUp(self):
+        super().setUp()
+        media = self.settings(MEDIA_ROOT=self.dir.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.jobs = UploadJobs(workers=0, limit=2, timeout=60 * 60)
+
+    def submit(self, page: str = 'План'):
+        with open(ParserTest.workbook(self.dir.name), 'rb') as f:
+            file = SimpleUploadedFile('plan.xlsx', f.read())
+        job = self.jobs.submit(self.user, file, page, self.rule, 'Информатика', self.faculty, self.degree, k=3)
+        job.refresh_from_db()
+        return job
+
+    def test_done(self):
+        job = self.submit()
+        self.assertEqual((job.status, job.progress, job.error), (UploadJob.DONE, 100, ''))
+        self.assertFalse(default_storage.exists(job.file))
+
+        row_data = staged_uploads.decode(job.staged.data)
+        self.assertEqual(row_data['subjects'], ['Математика', 'Физика', 'Экономика'])
+        self.assertEqual((row_data['specialty'], row_data['faculty'], row_data['degree']),
+                         ('Информатика', self.faculty.id, self.degree.id))
+        self.assertEqual(row_data['decisions'], {'0': [False, Subject.objects.get(subject='Математика').id]})
+
+    def test_failed_parse(self):
+        with self.assertLogs('listsapp.functionality.jobs', 'ERROR'):
+            job = self.submit(page='Нет такого листа')
+        self.assertEqual(job.status, UploadJob.FAILED)
+        self.assertTrue(job.error)
+        self.assertIsNone(job.staged)
+        self.assertFalse(default_storage.exists(job.file))
+
+    def test_limit_exceeded(self):
+        for _ in range(2):
+            UploadJob.objects.create(user=self.user, status=UploadJob.PARSING, id_rule=self.rule,
+                                     id_faculty=self.faculty, id_degree=self.degree)
+        with self.assertRaises(JobsLimitExceeded):
+            self.submit()
+        self.assertEqual(UploadJob.objects.count(), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, 'uploads')))
+
+    def test_expire(self):
+        stale, fresh = [UploadJob.objects.create(user=self.user, status=UploadJob.PARSING, id_rule=self.rule,
+                                                 id_faculty=self.faculty, id_degree=self.degree) for _ in range(2)]
+        # update не меняет поле auto_now
+        UploadJob.objects.filter(id=stale.id).update(updated=timezone.now() - timedelta(hours=2))
+        stale.refresh_from_db()
+        # брошенное задание не занимает место в limit
+        self.assertEqual(list(self.jobs.active()), [fresh])
+        self.submit()
+
+        self.assertEqual(self.jobs.expire(stale).status, UploadJob.FAILED)
+        self.assertTrue(UploadJob.objects.get(id=stale.id).error)
+        self.assertEqual(self.jobs.expire(fresh).status, UploadJob.PARSING)
+
+
+class BatchTest(TemporaryDirMixin, TestCase):
+    """ Пакетная загрузка: выбор листов, пропуск листов без дисциплин и объединение планов """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rule = Rule.objects.create(rule_name='Физтех', rule=ParserTest.RULE)
+        cls.other = Rule.objects.create(rule_name='Только ОНБ', rule=dict(ParserTest.RULE, ciphers=['ОНБ']))
+        cls.faculty = Faculty.objects.create(faculty='Физтех')
+        cls.degree = Degree.objects.create(degree='Бакалавриат')
+
+    def setUp(self):
+        super().setUp()
+        wb = Workbook()
+        wb.active.title = 'Титул'
+        wb.active.append(['Учебный план'])
+        for title, rows in (('Информатика', [('ОНБ.1', 'Математика'), ('ПБ.2', 'Программирование')]),
+                            ('Физика', [('ОНБ.1', 'Математика'), ('ПБ.2', 'Механика')])):
+            sh = wb.create_sheet(title)
+            sh.append(['Шифр', 'Дисциплина', 'Экзамены', 'Зачеты'])
+            for cipher, subject in rows:
+                sh.append(ParserTest.row(cipher, subject, '1', None, {1: (10, 20, 30)}))
+        self.plans = os.path.join(self.dir.name, 'plans.xlsx')
+        wb.save(self.plans)
+
+        wb = Workbook()
+        wb.active.append(['Шифр', 'Дисциплина', 'Экзамены', 'Зачеты'])
+        wb.active.append(ParserTest.row('ОНБ.1', 'Экономика', '2', None, {2: (1, 2, 3)}))
+        self.single = os.path.join(self.dir.name, 'upload.xlsx')
+        wb.save(self.single)
+
+    def test_sheet_items_default_names(self):
+        items = batch.sheet_items([(self.plans, 'plans.xlsx', None), (self.single, 'Экономика.xlsx', None)],
+                                  self.rule.rule, self.rule.id)
+        self.assertEqual([(_.file, _.wsh, _.specialty, _.rule_id) for _ in items], [
+            (self.plans, 'Титул', 'Титул', self.rule.id), (self.plans, 'Информатика', 'Информатика', self.rule.id),
+            (self.plans, 'Физика', 'Физика', self.rule.id), (self.single, 'Sheet', 'Экономика', self.rule.id)])
+
+    def test_sheet_items_selection(self):
+        items = batch.sheet_items([(self.plans, 'plans.xlsx', [['Физика', self.other.id, 'Техническая физика'],
+                                                              ['Информатика', None, 'Информатика']])],
+                                  self.rule.rule, self.rule.id)
+        self.assertEqual([(_.wsh, _.specialty, _.rule_id, _.rule) for _ in items], [
+            ('Физика', 'Техническая физика', self.other.id, self.other.rule),
+            ('Информатика', 'Информатика', self.rule.id, self.rule.rule)])
+
+    def test_empty_sheets_are_dropped_before_merge(self):
+        items = batch.sheet_items([(self.plans, 'plans.xlsx', None)], self.rule.rule, self.rule.id)
+        items, parsed, skipped = batch.drop_empty(items, batch.parse_batch(items, 1))
+        self.assertEqual(skipped, ['Титул (лист «Титул»)'])
+
+        merged = batch.merge_batch(items, parsed)
+        self.assertEqual(merged['subjects'], ['Математика', 'Программирование', 'Механика'])
+        self.assertEqual([(_['specialty'], _['exam']) for _ in merged['plans']], [
+            ('Информатика', [[0, 1, 10, 30, 20], [1, 1, 10, 30, 20]]),
+            ('Физика', [[0, 1, 10, 30, 20], [2, 1, 10, 30, 20]])])
+
+    def form(self, items: dict):
+        with open(self.plans, 'rb') as f:
+            files = {'batch-files': SimpleUploadedFile('plans.xlsx', f.read())}
+        data = {'batch-faculty': self.faculty.id, 'batch-degree': self.degree.id, 'batch-rule': self.rule.id,
+                'item-TOTAL_FORMS': len(items), 'item-INITIAL_FORMS': 0}
+        for i, (sheet, specialty) in enumerate(items.items()):
+            data.update({f'item-{i}-file': 0, f'item-{i}-sheet': sheet, f'item-{i}-include': 'on',
+                         f'item-{i}-specialty': specialty, f'item-{i}-rule': self.other.id})
+        return BatchUploadForm(data, files, items=BatchItemFormSet(data, prefix='item'))
+
+    def test_form_selection(self):
+        form = self.form({'Физика': 'Техническая физика'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['selection'], [[['Физика', self.other.id, 'Техническая физика']]])
+
+        form = self.form({'График': 'График'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('Лист «График» не найден в загруженных файлах', form.non_field_errors())
+
+
+def create_plan(specialty: Specialty, rows: list):
+    """ rows - [(дисциплина, семестр, лекции, лабораторные, практика)] """
+    subjects = {_.subject: _ for _ in Subject.objects.all()}
+    for name, semester, lecture, laboratory, practice in rows:
+        if name not in subjects:
+            subjects[name] = Subject.objects.create(subject=name)
+        AcademicPlan.objects.create(id_specialty=specialty, id_subject=subjects[name], semester=semester,
+                                    control=AcademicPlan.EXAM, h_lecture=lecture, h_laboratory=laboratory,
+                                    h_practice=practice)
+
+
+class AcademicDifferenceComparisonTest(TestCase):
+    """ Строки одной дисциплины сопоставляются по порядку семестров. Там, где у каждой такой строки будущего плана
+    есть пара, результат совпадает с прежним compare() (zip строк, упорядоченных по id дисциплины) """
+
+    @classmethod
+    def setUpTestData(cls):
+        degree = Degree.objects.create(degree='Бакалавриат')
+        faculty = Faculty.objects.create(faculty='Физтех')
+        cls.source = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty='Информатика')
+        cls.target = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty='Прикладная математика')
+        create_plan(cls.source, [('Математика', 1, 36, 0, 36), ('Физика', 2, 18, 18, 18), ('Математика', 2, 18, 0, 36),
+                                 ('История', 1, 18, 0, 18), ('Программирование', 3, 36, 36, 0)])
+        create_plan(cls.target, [('Математика', 1, 36, 0, 36), ('Философия', 1, 18, 0, 18), ('Физика', 3, 18, 18, 0),
+                                 ('Математика', 2, 36, 0, 36), ('Основы программирования', 3, 36, 36, 0)])
+
+    def difference(self, from_semester, to_semester):
+        return [(_['academic'].id_subject.subject, _['academic'].semester, _['is_differ'], _['deficit'])
+                for _ in AcademicDifferenceComparison(self.source, from_semester, self.target, to_semester).compare()]
+
+    def test_same_subjects_match_previous_compare(self):
+        # is_differ и порядок строк - вывод compare() из исходной версии на этих планах
+        self.assertEqual(self.difference(8, 8), [
+            ('Математика', 1, False, 0), ('Математика', 2, True, 18), ('Физика', 3, False, 0),
+            ('Философия', 1, True, 36), ('Основы программирования', 3, False, 0)])
+        self.assertEqual(self.difference(2, 3), [
+            ('Математика', 1, False, 0), ('Математика', 2, True, 18), ('Физика', 3, False, 0),
+            ('Философия', 1, True, 36), ('Основы программирования', 3, True, 72)])
+
+    def test_unpaired_same_subject_row_is_a_difference(self):
+        # прежний zip отбрасывал вторую строку «Математики», для которой нет пары в текущем плане
+        self.assertEqual(self.difference(1, 2), [
+            ('Математика', 1, False, 0), ('Математика', 2, True, 72), ('Философия', 1, True, 36)])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AcademicDifferenceMatrixTest(TestCase):
+    """ Сохраненные разницы пересчитываются после изменения плана, один раз на специальность """
+
+    @classmethod
+    def setUpTestData(cls):
+        degree = Degree.objects.create(degree='Бакалавриат')
+        faculty = Faculty.objects.create(faculty='Физтех')
+        cls.source = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty='Информатика')
+        cls.target = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty='Прикладная математика')
+        create_plan(cls.source, [('Математика', 1, 36, 0, 36), ('Физика', 2, 18, 18, 18), ('История', 1, 18, 0, 18)])
+        create_plan(cls.target, [('Математика', 1, 36, 0, 54), ('Базы данных', 2, 18, 36, 0)])
+
+    def setUp(self):
+        patcher = mock.patch.object(matrix, 'academic_refresh', AcademicDifferenceRefresh(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        AcademicDifferenceMatrix.build()
+
+    def stored(self):
+        return AcademicDifference.objects.get(id_from_specialty=self.source, from_semester=AcademicPlan.MAX_SEMESTER,
+                                              id_to_specialty=self.target, to_semester=AcademicPlan.MAX_SEMESTER)
+
+    def expected(self):
+        return AcademicDifferenceMatrix.pack(AcademicDifferenceComparison(
+            self.source, AcademicPlan.MAX_SEMESTER, self.target, AcademicPlan.MAX_SEMESTER).compare())
+
+    def test_plan_change_refreshes_stored_difference(self):
+        before = self.stored().difference
+        with mock.patch.object(AcademicDifferenceMatrix, 'invalidate',
+                               wraps=AcademicDifferenceMatrix.invalidate) as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            create_plan(self.target, [('Программирование', 3, 36, 36, 0), ('Физика', 2, 18, 18, 18)])
+        invalidate.assert_called_once()
+        self.assertIn(self.target.id, invalidate.call_args[0][0])
+
+        self.assertNotEqual(self.stored().difference, before)
+        self.assertEqual(self.stored().difference, self.expected())
+
+    def test_difference_computed_during_plan_change_is_not_stored(self):
+        AcademicDifference.objects.all().delete()
+        compare = AcademicDifferenceComparison.compare
+
+        def compare_while_plan_changes(comparison):
+            bump_version(f'plan:{self.target.id}')
+            return compare(comparison)
+
+        with mock.patch.object(AcademicDifferenceComparison, 'compare', compare_while_plan_changes):
+            difference = AcademicDifferenceMatrix.get(self.source, AcademicPlan.MAX_SEMESTER,
+                                                      self.target, AcademicPlan.MAX_SEMESTER)
+        self.assertEqual(AcademicDifferenceMatrix.pack(difference), self.expected())
+        self.assertFalse(AcademicDifference.objects.exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SubjectsContextTest(TestCase):
+    """ Закэшированный список дисциплин пересчитывается после изменения плана, дисциплины, групп и специальности """
+
+    @classmethod
+    def setUpTestData(cls):
+        degree = Degree.objects.create(degree='Бакалавриат')
+        faculty = Faculty.objects.create(faculty='Физтех')
+        cls.specialty = Specialty.objects.create(id_degree=degree, id_faculty=faculty, specialty='Информатика')
+        create_plan(cls.specialty, [('Математика', 1, 36, 0, 36), ('Физика', 2, 18, 18, 18)])
+        Group.objects.create(id_specialty=cls.specialty, enter_year=2021, name='ИН-1')
+
+    def setUp(self):
+        patcher = mock.patch.object(matrix, 'academic_refresh', AcademicDifferenceRefresh(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subjects(self):
+        context = cached_subjects_context(subjects_context, self.specialty.id, 1)
+        return [_.id_subject.subject for _ in context['subjects']]
+
+    def user_context(self):
+        return cached_subjects_context(subjects_user_context, self.specialty.id, 0, 2021)
+
+    def test_plan_and_subject_changes(self):
+        self.assertEqual(self.subjects(), ['Математика'])
+        with self.assertNumQueries(0):
+            self.subjects()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_plan(self.specialty, [('История', 1, 18, 0, 18)])
+        self.assertEqual(sorted(self.subjects()), ['История', 'Математика'])
+
+        subject = Subject.objects.get(subject='История')
+        subject.subject = 'История России'
+        with self.captureOnCommitCallbacks(execute=True):
+            subject.save()
+        self.assertEqual(sorted(self.subjects()), ['История России', 'Математика'])
+
+    def test_group_and_specialty_changes(self):
+        self.assertEqual(self.user_context()['subjects'][0]['groups'], 1)
+        Group.objects.create(id_specialty=self.specialty, enter_year=2021, name='ИН-2')
+        self.assertEqual(self.user_context()['subjects'][0]['groups'], 2)
+
+        self.specialty.specialty = 'Прикладная информатика'
+        self.specialty.save()
+        self.assertIn('Прикладная информатика', self.user_context()['title'])
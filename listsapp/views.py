@@ -1,23 +1,31 @@
+import json
+
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Count
-from django.forms import formset_factory, BaseFormSet, forms
-from django.http import Http404
-from django.shortcuts import render, redirect
+from django.forms import formset_factory, forms
+from django.http import Http404, JsonResponse
+from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.generic import ListView
 from django.views.generic.edit import FormMixin, CreateView, FormView
 
-from .forms import UploadFileForm, SubjectFilterForm, SubjectFilterUserForm, PlanItemUpload, SubjectConflictSolve, \
-    INPUT_CLASS, SendMessageForm
+from .forms import UploadFileForm, BatchUploadForm, BatchItemFormSet, SubjectFilterForm, SubjectFilterUserForm, \
+    PlanItemUpload, SubjectConflictSolve, check_new_subjects, INPUT_CLASS, SELECT_CLASS, CHECK_CLASS, SendMessageForm
 from .functionality.comparison import FuzzySubjectsComparison, AcademicDifferenceComparison
-from .functionality.parser import Parser
+from .functionality.matrix import AcademicDifferenceMatrix
+from .functionality import workbook
+from .functionality.jobs import upload_jobs, JobsLimitExceeded
+from .functionality.staging import staged_uploads
+from .functionality.versions import get_version
 
-from .models import AcademicPlan, Specialty, Group, Subject, AdminMessage
+from .models import AcademicPlan, Specialty, Group, Subject, Rule, AdminMessage, UploadJob, \
+    drop_academic_differences, create_subjects
 
 
 # Create your views here.
@@ -48,15 +56,22 @@ class SendMessageView(FormView):
         return super(SendMessageView, self).form_valid(form)
 
 
+def upload_expired(request):
+    """ Загрузки из сессии нет или она устарела (см. StagedUploads.load): загрузка начинается заново """
+    messages.error(request, "Загрузка не найдена или устарела, загрузите файл заново")
+    return redirect('upload')
+
+
 @method_decorator(login_required, name='dispatch')
 class PlanItemsCreateView(View):
+    staged = None
     row_data = dict()
     template_name = 'upload_items.html'
     PlanItemsFormSet = formset_factory(PlanItemUpload)
 
     @staticmethod
-    def init_item(subj, item):
-        subject = Subject.objects.get(id=subj[item[0]])
+    def init_item(subj, subjects, item):
+        subject = subjects[subj[item[0]]]
         return dict(id_subject=subj[item[0]],
                     subject=subject.subject,
                     semester=item[1],
@@ -66,20 +81,20 @@ class PlanItemsCreateView(View):
                     control=item[5])
 
     def init_forms(self, request):
-        request.session['row_data'] = self.row_data
         subj = self.row_data.get('subjects')
         data = [_ + [AcademicPlan.EXAM] for _ in self.row_data.get('exam')] + \
                [_ + [AcademicPlan.QUIZ] for _ in self.row_data.get('quiz')] + \
                [_ + [AcademicPlan.M_QU] for _ in self.row_data.get('m_qu')]
         data = sorted(data, key=lambda x: x[0])
-        init = [self.init_item(subj, e) for e in data]
+        subjects = Subject.objects.in_bulk(set(subj))
+        init = [self.init_item(subj, subjects, e) for e in data]
         return init
 
     def get(self, request):
 
-        self.row_data = request.session.pop("row_data", None)
+        self.staged, self.row_data = staged_uploads.load(request)
         if self.row_data is None:
-            raise Http404('')
+            return upload_expired(request)
 
         init = self.init_forms(request)
         formset = self.PlanItemsFormSet(initial=init)
@@ -88,102 +103,239 @@ class PlanItemsCreateView(View):
         return render(request, self.template_name, {'plan_formset': formset})
 
     def post(self, request):
-        self.row_data = request.session.pop("row_data", None)
+        self.staged, self.row_data = staged_uploads.load(request)
         if self.row_data is None:
-            raise Http404('')
+            return upload_expired(request)
 
         init = self.init_forms(request)
         formset = self.PlanItemsFormSet(request.POST, initial=init)
         formset.forms = formset.initial_forms
-        request.session['row_data'] = self.row_data
 
         if formset.is_valid():
             faculty = self.row_data.get('faculty')
             degree = self.row_data.get('degree')
-            spec = Specialty(id_faculty_id=faculty, id_degree_id=degree, specialty=self.row_data.get('specialty'))
-            spec.save()
-            for form in formset:
-                form.cleaned_data.pop('subject')
-                form.cleaned_data['id_specialty'] = spec
-                form.cleaned_data['id_subject_id'] = form.cleaned_data.pop('id_subject')
-                plan = AcademicPlan(**form.cleaned_data)
-                plan.save()
+            with transaction.atomic():
+                spec = Specialty.objects.create(id_faculty_id=faculty, id_degree_id=degree,
+                                                specialty=self.row_data.get('specialty'))
+                plans = []
+                for form in formset:
+                    form.cleaned_data.pop('subject')
+                    form.cleaned_data['id_specialty'] = spec
+                    form.cleaned_data['id_subject_id'] = form.cleaned_data.pop('id_subject')
+                    plans.append(AcademicPlan(**form.cleaned_data))
+                AcademicPlan.objects.bulk_create(plans)
+                # bulk_create не отправляет post_save, поэтому academic_plan_changed вызывается вручную
+                drop_academic_differences([spec.id])
+
+            # пакетная загрузка: дисциплины уже сопоставлены для всех планов, дальше следующий план
+            batch = self.row_data.get('batch')
+            if batch:
+                self.row_data.update(batch.pop(0))
+                staged_uploads.save(self.staged, self.row_data)
+                messages.success(request, f"План специальности «{spec}» сохранен")
+                return redirect('upload_items')
+            staged_uploads.finish(request, self.staged)
             return redirect('home')
 
         context = dict(plan_formset=formset)
         return render(request, self.template_name, context)
 
 
-class BaseSubjectFormSet(BaseFormSet):
-
-    def set_total_via_init(self):
-        self.forms = self.initial_forms
-
-    def clean(self):
-        super().clean()
-        if any(self.errors):
-            return
-
-        new_subjects = []
-        for form in self.forms:
-            subj = form.cleaned_data.get('subject')
-            flag = form.cleaned_data.get('is_create')
-            if flag and subj in new_subjects:
-                raise ValidationError("Нельзя создать две дисциплины с одним названием!")
-            new_subjects.append(subj)
-
-
 @method_decorator(login_required, name='dispatch')
 class SubjectConflictView(View):
+    """ Сопоставление дисциплин загруженного плана с существующими
+    ____________
+    строки, сопоставленные автоматически (FuzzySubjectsComparison.resolveAll), не показываются;
+    страница подгружает остальные строки порциями через SubjectConflictRowsView и сохраняет решения по мере выбора;
+    POST применяет решения по всем строкам: создает новые дисциплины и переходит к строкам плана
+    """
+    staged = None
     row_data = dict()
-    forms = list()
-    SubjectFormSet = formset_factory(SubjectConflictSolve, formset=BaseSubjectFormSet)
     template = 'upload_conflicts.html'
+    LIKES_COUNT = 10
+    PAGE_SIZE = 25
 
-    def init_forms(self):
-        similars = FuzzySubjectsComparison(self.row_data.get('subjects')).compareAll()
-        init = [dict(likes_choices=lc, subject=_) for _, lc in zip(self.row_data.get('subjects'), similars)]
-        return init
-
-    def get(self, request):
-        self.row_data = request.session.pop("row_data", None)
+    @staticmethod
+    def decision(row_data: dict, i: int):
+        """ Решение по строке i: сохраненное, иначе связь с самой похожей дисциплиной,
+        а если похожих нет - создание новой с исходным названием
+        ____________
+        формат выхода:
+        (is_create, название новой дисциплины или id существующей)
+        """
+        saved = row_data.get('decisions', {}).get(str(i))
+        if saved is not None:
+            return tuple(saved)
+        likes = row_data['likes'][i]
+        return (False, likes[0][1]) if likes else (True, row_data['subjects'][i])
+
+    def load(self, request, for_update: bool = False):
+        """ False, если загрузки нет или она устарела """
+        self.staged, self.row_data = staged_uploads.load(request, for_update=for_update)
         if self.row_data is None:
-            raise Http404('')
-        request.session['row_data'] = self.row_data
+            return False
+        if 'likes' not in self.row_data:
+            likes, decisions, pending = FuzzySubjectsComparison(self.row_data['subjects']) \
+                .resolveAll(k=self.LIKES_COUNT)
+            self.row_data.update(likes=likes, decisions=decisions, pending=pending)
+            staged_uploads.save(self.staged, self.row_data)
+        return True
 
-        init = self.init_forms()
-        formset = self.SubjectFormSet(initial=init)
-        formset.set_total_via_init()
+    @staticmethod
+    def pending(row_data: dict):
+        """ Номера строк для ручной проверки """
+        return row_data.get('pending', range(len(row_data['subjects'])))
 
-        context = dict(subject_formset=formset)
-        return render(request, self.template, context)
+    @staticmethod
+    def auto(row_data: dict):
+        """ Номера строк, сопоставленных автоматически """
+        pending = set(SubjectConflictView.pending(row_data))
+        return [i for i in range(len(row_data['subjects'])) if i not in pending]
+
+    def context(self, errors: dict = None):
+        subjects = self.row_data['subjects']
+        pending = self.pending(self.row_data)
+        position = {i: (False, n) for n, i in enumerate(pending)}
+        position.update({i: (True, n) for n, i in enumerate(self.auto(self.row_data))})
+        errors = [dict(index=i + 1, auto=position[i][0], page=position[i][1] // self.PAGE_SIZE + 1,
+                       subject=subjects[i], error=str(e))
+                  for i, e in sorted((errors or {}).items())]
+        first = {e['auto']: e['page'] for e in reversed(errors)}
+        return dict(count=len(pending), auto=len(subjects) - len(pending), errors=errors,
+                    skipped=self.row_data.get('skipped', []),
+                    pending_page=first.get(False), auto_page=first.get(True), auto_errors=True in first,
+                    config=dict(rows_url=reverse('upload_conflicts_rows'), input_class=INPUT_CLASS,
+                                select_class=SELECT_CLASS, check_class=CHECK_CLASS))
+
+    def get(self, request):
+        if not self.load(request):
+            return upload_expired(request)
+        return render(request, self.template, self.context())
 
     def post(self, request):
-        self.row_data = request.session.pop("row_data", None)
-        if self.row_data is None:
+        with transaction.atomic():
+            # ждет незавершенных сохранений решений из SubjectConflictRowsView.post
+            if not self.load(request, for_update=True):
+                return upload_expired(request)
+            decisions = [self.decision(self.row_data, i) for i in range(len(self.row_data['subjects']))]
+            errors = check_new_subjects({i: value for i, (is_create, value) in enumerate(decisions) if is_create})
+            if errors:
+                return render(request, self.template, self.context(errors))
+
+            created = create_subjects([value for is_create, value in decisions if is_create])
+            self.row_data['subjects'] = [created[value] if is_create else value for is_create, value in decisions]
+            self.row_data.pop('likes')
+            self.row_data.pop('decisions', None)
+            self.row_data.pop('pending', None)
+            self.row_data.pop('skipped', None)
+            staged_uploads.save(self.staged, self.row_data)
+        return redirect('upload_items')
+
+
+@method_decorator(login_required, name='dispatch')
+class SubjectConflictRowsView(View):
+    """ JSON API страницы сопоставления: строки для ручной проверки (или, при ?auto=1, сопоставленные
+    автоматически) одной страницы с похожими дисциплинами (не больше SubjectConflictView.LIKES_COUNT на строку)
+    и сохранение решений по строкам
+    """
+
+    def get(self, request):
+        staged, row_data = staged_uploads.load(request)
+        if row_data is None or 'likes' not in row_data:
             raise Http404('')
-        request.session['row_data'] = self.row_data
 
-        init = self.init_forms()
-        formset = self.SubjectFormSet(request.POST, initial=init)
-        formset.set_total_via_init()
+        auto = bool(request.GET.get('auto'))
+        listed = SubjectConflictView.auto(row_data) if auto else SubjectConflictView.pending(row_data)
+        size, count = SubjectConflictView.PAGE_SIZE, len(listed)
+        pages = max(1, -(-count // size))
+        try:
+            page = min(max(int(request.GET.get('page', 1)), 1), pages)
+        except ValueError:
+            page = 1
+        rows = listed[(page - 1) * size:page * size]
+        if auto:
+            row_data = self.load_candidates(request, row_data, rows)
+        likes = row_data['likes']
+        subjects = Subject.objects.in_bulk({i for r in rows for _, i in likes[r]})
+
+        result = []
+        for r in rows:
+            is_create, value = SubjectConflictView.decision(row_data, r)
+            result.append(dict(index=r, subject=row_data['subjects'][r], is_create=is_create, value=value,
+                               candidates=[dict(id=i, subject=subjects[i].subject, score=round(v, 3))
+                                           for v, i in likes[r] if i in subjects]))
+        return JsonResponse(dict(page=page, pages=pages, count=count, rows=result))
 
-        if formset.is_valid():
-            subj = list()
-            for _ in formset.cleaned_data:
-                if _['is_create']:
-                    s = Subject(subject=_['subject'])
-                    s.save()
-                    subj.append(s.id)
-                else:
-                    subj.append(int(_['sub_likes']))
+    @staticmethod
+    def load_candidates(request, row_data: dict, rows: list):
+        """ Похожие дисциплины для строк rows, сопоставленных точным совпадением: нечеткое сравнение
+        для них пропускается при загрузке и выполняется, только когда пользователь открывает их список
+        ____________
+        формат выхода:
+        row_data с сохраненными похожими дисциплинами
+        """
+        missing = [r for r in rows if len(row_data['likes'][r]) < 2]
+        if not missing:
+            return row_data
+        ranks = FuzzySubjectsComparison([row_data['subjects'][r] for r in missing]) \
+            .compareAllCached(k=SubjectConflictView.LIKES_COUNT)
+        with transaction.atomic():
+            staged, row_data = staged_uploads.load(request, for_update=True)
+            if row_data is None:
+                raise Http404('')
+            for r, rank in zip(missing, ranks):
+                likes = [[v, s.id] for v, s in rank]
+                is_create, value = SubjectConflictView.decision(row_data, r)
+                if not is_create and all(i != value for _, i in likes):
+                    likes.insert(0, [1.0, value])
+                row_data['likes'][r] = likes
+            staged_uploads.save(staged, row_data)
+        return row_data
+
+    def post(self, request):
+        """ Тело запроса: {"decisions": {номер строки: {"is_create": bool, "subject": str, "sub_likes": id}}};
+        загрузка блокируется до сохранения, поэтому одновременные запросы не теряют решения друг друга
+        """
+        try:
+            decisions = {int(i): d for i, d in json.loads(request.body)['decisions'].items()}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return JsonResponse(dict(error='Неверный формат запроса'), status=400)
+
+        with transaction.atomic():
+            staged, row_data = staged_uploads.load(request, for_update=True)
+            if row_data is None or 'likes' not in row_data:
+                raise Http404('')
+            if any(not 0 <= i < len(row_data['subjects']) or not isinstance(d, dict) for i, d in decisions.items()):
+                return JsonResponse(dict(error='Неверный номер строки'), status=400)
+            errors = self.apply(staged, row_data, decisions)
+        return JsonResponse(dict(saved=len(decisions) - len(errors), errors={i: str(e) for i, e in errors.items()}))
 
-            self.row_data['subjects'] = subj
-            request.session['row_data'] = self.row_data
-            return redirect('upload_items')
+    @staticmethod
+    def apply(staged, row_data: dict, decisions: dict):
+        """ Проверяет решения по строкам и сохраняет верные
+        ____________
+        формат выхода:
+        dict[номер строки: ошибка]
+        """
+        likes = row_data['likes']
+        subjects = Subject.objects.in_bulk({i for r in decisions for _, i in likes[r]})
+        errors, valid = dict(), dict()
+        for i, d in decisions.items():
+            form = SubjectConflictSolve(data=dict(subject=d.get('subject'), is_create=bool(d.get('is_create')),
+                                                  sub_likes=d.get('sub_likes')),
+                                        initial=dict(likes_choices=[(v, subjects[j]) for v, j in likes[i]
+                                                                    if j in subjects]))
+            if form.is_valid():
+                c = form.cleaned_data
+                valid[i] = [True, c['subject']] if c['is_create'] else [False, int(c['sub_likes'])]
+            else:
+                errors[i] = ' '.join(str(e) for field in form.errors.values() for e in field)
+        errors.update(check_new_subjects({i: d[1] for i, d in valid.items() if d[0]}))
 
-        context = dict(subject_formset=formset)
-        return render(request, self.template, context)
+        saved = row_data.setdefault('decisions', dict())
+        saved.update({str(i): d for i, d in valid.items() if i not in errors})
+        staged_uploads.save(staged, row_data)
+        return errors
 
 
 @login_required
@@ -191,39 +343,115 @@ def upload_file(request):
     context = {'upload': UploadFileForm()}
     if request.method == 'POST':
         upload_form = UploadFileForm(request.POST, request.FILES)
-        upload_form.set_page(request.POST.get('upload-page'))
         if upload_form.is_valid():
-            file = upload_form.cleaned_data['file']
-            rule = upload_form.cleaned_data['rule'].rule
-            page = upload_form.cleaned_data['page']
-            row_data = Parser(file, page, rule).parse()
-            row_data['specialty'] = upload_form.cleaned_data['specialty']
-            row_data['faculty'] = upload_form.cleaned_data['faculty'].id
-            row_data['degree'] = upload_form.cleaned_data['degree'].id
-
-            request.session['row_data'] = row_data
-            request.session['key'] = True
-            return redirect('upload_conflicts')
-        else:
-            context['upload'] = upload_form
+            try:
+                job = upload_jobs.submit(request.user, upload_form.cleaned_data['file'],
+                                         page=upload_form.cleaned_data['page'],
+                                         rule=upload_form.cleaned_data['rule'],
+                                         specialty=upload_form.cleaned_data['specialty'],
+                                         faculty=upload_form.cleaned_data['faculty'],
+                                         degree=upload_form.cleaned_data['degree'],
+                                         k=SubjectConflictView.LIKES_COUNT)
+            except JobsLimitExceeded:
+                messages.error(request, "Сейчас обрабатывается слишком много файлов, попробуйте загрузить позже")
+            else:
+                return redirect('upload_job', job_id=job.id)
+        context['upload'] = upload_form
 
     return render(request, 'upload_file.html', context)
 
 
+@login_required
+def upload_sheets(request):
+    """ Листы загружаемого файла с размерами для выбора страницы в форме загрузки """
+    file = request.FILES.get('file')
+    if request.method != 'POST' or file is None:
+        return JsonResponse(dict(error='Файл не загружен'), status=400)
+    try:
+        return JsonResponse(dict(sheets=workbook.sheets(file)))
+    except ValueError as e:
+        return JsonResponse(dict(error=str(e)), status=400)
+
+
+@login_required
+def upload_batch(request):
+    context = {'upload': BatchUploadForm(), 'items': BatchItemFormSet(prefix='item'),
+               'rules': list(Rule.objects.values('id', 'rule_name'))}
+    if request.method == 'POST':
+        items = BatchItemFormSet(request.POST, prefix='item') if 'item-TOTAL_FORMS' in request.POST else None
+        upload_form = BatchUploadForm(request.POST, request.FILES, items=items)
+        if upload_form.is_valid():
+            try:
+                job = upload_jobs.submit_batch(request.user, upload_form.cleaned_data['files'],
+                                               rule=upload_form.cleaned_data['rule'],
+                                               faculty=upload_form.cleaned_data['faculty'],
+                                               degree=upload_form.cleaned_data['degree'],
+                                               k=SubjectConflictView.LIKES_COUNT,
+                                               selection=upload_form.cleaned_data['selection'])
+            except JobsLimitExceeded:
+                messages.error(request, "Сейчас обрабатывается слишком много файлов, попробуйте загрузить позже")
+            else:
+                return redirect('upload_job', job_id=job.id)
+        context['upload'] = upload_form
+
+    return render(request, 'upload_batch.html', context)
+
+
+@login_required
+def upload_job(request, job_id):
+    job = upload_jobs.expire(get_object_or_404(UploadJob, id=job_id, user=request.user))
+    if job.status == UploadJob.DONE:
+        if job.staged_id is None:
+            raise Http404('')
+        staged_uploads.stage(request, job.staged)
+        request.session['key'] = True
+        return redirect('upload_conflicts')
+    return render(request, 'upload_job.html', dict(job=job))
+
+
+@login_required
+def upload_job_status(request, job_id):
+    job = upload_jobs.expire(get_object_or_404(UploadJob, id=job_id, user=request.user))
+    return JsonResponse(dict(status=job.status, status_display=job.get_status_display(), progress=job.progress,
+                             error=job.error,
+                             redirect=reverse('upload_job', args=[job.id]) if job.status == UploadJob.DONE else None))
+
+
+SUBJECTS_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def cached_subjects_context(build, specialty: int, *args):
+    """ Контекст списка дисциплин из кэша Django; build(specialty, *args) считает его при промахе.
+    Ключ включает версии учебного плана специальности, групп и справочника специальностей,
+    которые меняются сигналами моделей, поэтому записи не нужно удалять при изменениях
+    """
+    key = f'subjects-list:{build.__name__}:{specialty}:{":".join(str(_) for _ in args)}:' \
+          f'{get_version(f"plan:{specialty}")}:{get_version("groups")}:{get_version("specialties")}'
+    context = cache.get(key)
+    if context is None:
+        context = build(specialty, *args)
+        cache.set(key, context, SUBJECTS_CACHE_TIMEOUT)
+    return dict(context)
+
+
+def subjects_context(sp: int, sem: int):
+    qs = AcademicPlan.objects.select_related('id_specialty', 'id_subject').all()
+    qs = qs.filter(id_specialty=sp).filter(semester=sem).order_by('control')
+    spec = Specialty.objects.select_related('id_faculty').get(id=sp)
+    context = {'subjects': list(qs),
+               'title': f"{spec.id_faculty} {spec} {sem} семестр",
+               }
+    return context
+
+
 def subjects_filter(request):
     try:
-        sp = request.GET.get('specialty')
-        sem = request.GET.get('semester')
+        sp = int(request.GET.get('specialty'))
+        sem = int(request.GET.get('semester'))
     except:
-        return None
+        return {}
     else:
-        qs = AcademicPlan.objects.select_related('id_specialty', 'id_subject').all()
-        qs = qs.filter(id_specialty=sp).filter(semester=sem).order_by('control')
-        spec = Specialty.objects.select_related('id_faculty').get(id=sp)
-        context = {'subjects': qs,
-                   'title': f"{spec.id_faculty} {spec} {sem} семестр",
-                   }
-        return context
+        return cached_subjects_context(subjects_context, sp, sem)
 
 
 def subjects_user_filter(request):
@@ -232,40 +460,44 @@ def subjects_user_filter(request):
         sem = int(request.GET['semester'])
         year = int(request.GET['year'])
     except:
-        return None
+        return {}
     else:
-        semesters = [i for i in range(1, AcademicPlan.MAX_SEMESTER + 1) if i % 2 != sem]
-        gr = Group.objects.select_related('id_specialty') \
-            .filter(id_specialty=spec) \
-            .filter(enter_year__range=(year - 3, year)) \
-            .values('enter_year').annotate(count=Count('id'))
-
-        qs = AcademicPlan.objects.select_related('id_specialty', 'id_subject') \
-            .filter(id_specialty=spec) \
-            .filter(semester__in=semesters) \
-            .order_by('semester')
-
-        s = {}
-        for q in qs:
-            if q.semester in s:
-                s[q.semester].append(q)
-            else:
-                s[q.semester] = [q, ]
+        return cached_subjects_context(subjects_user_context, spec, sem, year)
+
+
+def subjects_user_context(spec: int, sem: int, year: int):
+    semesters = [i for i in range(1, AcademicPlan.MAX_SEMESTER + 1) if i % 2 != sem]
+    gr = Group.objects.select_related('id_specialty') \
+        .filter(id_specialty=spec) \
+        .filter(enter_year__range=(year - 3, year)) \
+        .values('enter_year').annotate(count=Count('id'))
+
+    qs = AcademicPlan.objects.select_related('id_specialty', 'id_subject') \
+        .filter(id_specialty=spec) \
+        .filter(semester__in=semesters) \
+        .order_by('semester')
 
-        subjects = [{'course': ((i + 1) // 2), 'subjects': s[i]} for i in s]
-        if len(gr) < len(s):
-            for i, g in enumerate(gr):
-                subjects[i]['groups'] = g['count']
+    s = {}
+    for q in qs:
+        if q.semester in s:
+            s[q.semester].append(q)
         else:
-            for i, g in enumerate(gr[:len(s)]):
-                subjects[i]['groups'] = g['count']
+            s[q.semester] = [q, ]
 
-        sp = Specialty.objects.select_related('id_faculty').get(id=spec)
-        sem = 'осенний' if int(request.GET['semester']) == 0 else 'весенний'
-        context = {'subjects': subjects,
-                   'title': f"{sp.id_faculty} {sp} : {year}-{year + 1} уч.год {sem} семестр"
-                   }
-        return context
+    subjects = [{'course': ((i + 1) // 2), 'subjects': s[i]} for i in s]
+    if len(gr) < len(s):
+        for i, g in enumerate(gr):
+            subjects[i]['groups'] = g['count']
+    else:
+        for i, g in enumerate(gr[:len(s)]):
+            subjects[i]['groups'] = g['count']
+
+    sp = Specialty.objects.select_related('id_faculty').get(id=spec)
+    sem = 'осенний' if sem == 0 else 'весенний'
+    context = {'subjects': subjects,
+               'title': f"{sp.id_faculty} {sp} : {year}-{year + 1} уч.год {sem} семестр"
+               }
+    return context
 
 
 def subjects_filter_list(request):
@@ -294,15 +526,35 @@ def academ_difference_list(request):
         if from_specialty.is_valid() and to_specialty.is_valid():
             title = f"{from_specialty.cleaned_data['specialty']} ({from_specialty.cleaned_data['semester']} семестр) -> " \
                     f"{to_specialty.cleaned_data['specialty']} ({to_specialty.cleaned_data['semester']} семестр) "
-            difference_info = AcademicDifferenceComparison(
+            difference_info = AcademicDifferenceMatrix.get(
                 from_specialty=from_specialty.cleaned_data['specialty'],
                 from_semester=from_specialty.cleaned_data['semester'],
                 to_specialty=to_specialty.cleaned_data['specialty'],
                 to_semester=to_specialty.cleaned_data['semester']
-            ).compare()
+            )
             context = dict(from_specialty=from_specialty,
                            to_specialty=to_specialty,
                            difference=difference_info,
                            title=title)
 
     return render(request, 'academ_ask.html', context)
+
+
+def academ_targets(request):
+    """ Все специальности, на которые можно перевестись с текущей, по возрастанию академической разницы """
+    from_specialty = SubjectFilterForm(request.GET, prefix='from', years=4)
+    if not from_specialty.is_valid():
+        return JsonResponse(dict(errors=from_specialty.errors), status=400)
+    to_semester = request.GET.get('to-semester') or from_specialty.cleaned_data['semester']
+    if to_semester not in {str(i) for i, _ in from_specialty.fields['semester'].choices}:
+        return JsonResponse(dict(errors=dict(semester=['Неверный семестр'])), status=400)
+
+    targets = AcademicDifferenceComparison.compareTargets(
+        from_specialty=from_specialty.cleaned_data['specialty'],
+        from_semester=from_specialty.cleaned_data['semester'],
+        to_semester=to_semester
+    )
+    return JsonResponse(dict(targets=[dict(specialty=t['specialty'].id,
+                                           title=str(t['specialty']),
+                                           differ=t['differ'],
+                                           deficit=t['deficit']) for t in targets]))